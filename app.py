@@ -8,13 +8,39 @@ import datetime
 import random
 import time
 import tempfile
+import glob
 import subprocess
+import queue
+import http.cookiejar
+import shutil
+import sys
 import re
+import threading
+import zlib
+import hashlib
+import contextvars
+import sqlite3
+import inspect
+import pickle
+import bisect
+from collections import OrderedDict
 from functools import lru_cache
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from flask import Flask, render_template, request, jsonify, Response, redirect, url_for, session, send_file
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from flask import Flask, render_template, stream_template, stream_with_context, request, jsonify, Response, redirect, url_for, session, send_file, g, has_request_context
 from functools import wraps
-import yt_dlp
+from werkzeug.security import safe_join
+import io
+
+try:
+    from PIL import Image
+    Image.init()
+except ImportError:
+    Image = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 app.config['JSON_AS_ASCII'] = False
@@ -77,10 +103,56 @@ EDU_PARAM_SOURCES = {
     }
 }
 
-_edu_params_cache = {}
-_edu_cache_timestamp = {}
-_trending_cache = {'data': None, 'timestamp': 0}
-_thumbnail_cache = {}
+_swr_cache = {}
+_swr_refreshing = set()
+_swr_lock = threading.Lock()
+THUMBNAIL_CACHE_TTL = 3600
+THUMBNAIL_CACHE_MAX_BYTES = int(os.environ.get('THUMBNAIL_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+
+_thumbnail_cache = OrderedDict()
+_thumbnail_cache_bytes = 0
+_thumbnail_cache_lock = threading.Lock()
+_thumbnail_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+# ディスク上のキャッシュを置くこのユーザー専用のディレクトリ
+# 他のユーザーが書き込めると、キャッシュに仕込まれた内容をそのまま配信・読み込みしてしまう
+PRIVATE_CACHE_DIR = os.path.join(tempfile.gettempdir(), f"chocotube_cache_{os.getuid() if hasattr(os, 'getuid') else 'user'}")
+
+def _private_directory(directory, label):
+    """directoryが自分専用 (自分の所有で他人が書き込めない) ならそのパスを、そうでなければ空文字を返す"""
+    if not directory:
+        return ''
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        st = os.stat(directory)
+    except OSError as e:
+        print(f"{label} disabled ({directory}): {e}")
+        return ''
+    if (hasattr(os, 'getuid') and st.st_uid != os.getuid()) or st.st_mode & 0o022:
+        print(f"{label} disabled: {directory} is writable by other users")
+        return ''
+    return directory
+
+# ディスク上のコンテンツアドレス型サムネイルストア (objects/<sha256先頭2文字>/<sha256>)。使えない場合は空文字
+THUMBNAIL_STORE_DIR = _private_directory(os.environ.get('THUMBNAIL_STORE_DIR', os.path.join(PRIVATE_CACHE_DIR, 'thumbnails')), 'Thumbnail store')
+THUMBNAIL_STORE_MAX_BYTES = int(os.environ.get('THUMBNAIL_STORE_MAX_BYTES', str(512 * 1024 * 1024)))
+THUMBNAIL_JANITOR_INTERVAL = 600
+
+_thumbnail_janitor_started = False
+_thumbnail_fetches = {}
+_thumbnail_fetches_lock = threading.Lock()
+
+THUMBNAIL_STREAM_CHUNK_SIZE = 16 * 1024
+
+# サムネイルのリサイズ・変換 (Pillowがない環境では元画像をそのまま返す)
+THUMBNAIL_WIDTHS = (120, 160, 240, 320, 480)
+THUMBNAIL_FORMATS = {
+    'jpeg': {'mimetype': 'image/jpeg', 'pil': 'JPEG', 'options': {'quality': 80, 'optimize': True, 'progressive': True}},
+    'webp': {'mimetype': 'image/webp', 'pil': 'WEBP', 'options': {'quality': 75, 'method': 4}},
+    'avif': {'mimetype': 'image/avif', 'pil': 'AVIF', 'options': {'quality': 60}},
+}
+
+_image_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='image')
 
 http_session = requests.Session()
 retry_strategy = Retry(total=2, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504])
@@ -106,23 +178,399 @@ INVIDIOUS_INSTANCES = [
     'https://iv.duti.dev/',
 ]
 
+# Invidious呼び出しのヘッジ設定 (hedge: 遅延後に次のインスタンスへ送信 / race: 全インスタンスへ同時送信 / sequential: 従来通り順番に試行)
+INVIDIOUS_HEDGE_MODE = os.environ.get('INVIDIOUS_HEDGE_MODE', 'hedge')
+INVIDIOUS_FANOUT = int(os.environ.get('INVIDIOUS_FANOUT', '3'))
+INVIDIOUS_HEDGE_DELAY = float(os.environ.get('INVIDIOUS_HEDGE_DELAY', '0.8'))
+
+_upstream_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='upstream')
+
+# 視聴ページのデータ取得 (動画情報・ストリームは必須、プレイリストは任意)
+WATCH_PAGE_TIMEOUT = float(os.environ.get('WATCH_PAGE_TIMEOUT', '20'))
+WATCH_OPTIONAL_TIMEOUT = float(os.environ.get('WATCH_OPTIONAL_TIMEOUT', '3'))
+
+_page_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='page')
+
+# 視聴・検索・チャンネルページを逐次描画し、上流の応答を待たずにページの枠を先に送る
+STREAM_RENDERING = os.environ.get('STREAM_RENDERING', 'true').lower() != 'false'
+STREAM_FLUSH_SIZE = 8192
+
+# リクエスト全体の期限 (秒)。上流への各呼び出しのタイムアウトは残り時間に切り詰められる
+DEFAULT_REQUEST_BUDGET = float(os.environ.get('REQUEST_BUDGET', '30'))
+REQUEST_BUDGETS = {
+    'api_convert_direct': 120,
+}
+
+_request_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+# インスタンスのヘルス管理 (成功率・レイテンシEWMA・サーキットブレーカー)
+INSTANCE_FAILURE_THRESHOLD = 3
+INSTANCE_COOLDOWN = 30
+INSTANCE_MAX_COOLDOWN = 600
+INSTANCE_PROBE_INTERVAL = int(os.environ.get('INSTANCE_PROBE_INTERVAL', '120'))
+INSTANCE_EWMA_ALPHA = 0.3
+
+_instance_health = {}
+_instance_health_lock = threading.Lock()
+_instance_prober_started = False
+
+_inflight_requests = {}
+_inflight_lock = threading.Lock()
+
+# ネガティブキャッシュ (存在しない動画や全ソース失敗を短時間記録し、ネットワークに触れずに即失敗させる)
+NEGATIVE_CACHE_TTL = {
+    'not_found': 600,
+    'failed': 30,
+}
+NEGATIVE_CACHE_MAX_ENTRIES = 5000
+VIDEO_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+_negative_cache = OrderedDict()
+_negative_cache_lock = threading.Lock()
+_upstream_miss_reason = contextvars.ContextVar('upstream_miss_reason', default=None)
+_INVIDIOUS_NOT_FOUND = object()
+
+# メタデータキャッシュ (種類ごとのTTL + 件数・バイト数によるLRU)
+METADATA_CACHE_TTL = {
+    'video': 600,
+    'channel': 900,
+    'channel_videos': 600,
+    'playlist': 900,
+    'comments': 300,
+    # yt-dlpの抽出結果はフォーマットURLの有効期限まで
+    'ydl_info': lambda info: _extract_info_ttl(info),
+}
+METADATA_CACHE_MAX_ENTRIES = int(os.environ.get('METADATA_CACHE_MAX_ENTRIES', '2000'))
+METADATA_CACHE_MAX_BYTES = int(os.environ.get('METADATA_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+_metadata_cache = OrderedDict()
+_metadata_cache_bytes = 0
+_metadata_cache_lock = threading.Lock()
+_metadata_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+# プレイリストの通し番号順の動画一覧 (ページ単位で必要な分だけ読み込む)
+PLAYLIST_WINDOW_BEFORE = 20
+PLAYLIST_WINDOW_AFTER = 80
+PLAYLIST_MAX_VIDEOS = int(os.environ.get('PLAYLIST_MAX_VIDEOS', '5000'))
+PLAYLIST_STORE_MAX_ENTRIES = 256
+
+_playlist_store = OrderedDict()
+_playlist_store_lock = threading.Lock()
+
+# 同一ホスト上の全gunicornワーカーで共有するキャッシュ (SQLite WALモード)。空文字で無効化
+# 値はpickleで読み込むため、置き場所は自分以外が書き込めないディレクトリに限る
+SHARED_CACHE_LEASE_WAIT = 5
+
+def _private_shared_cache_path(path):
+    """キャッシュファイルのディレクトリが自分専用でなければ共有キャッシュを無効にする"""
+    if not path or not _private_directory(os.path.dirname(os.path.abspath(path)), 'Shared cache'):
+        return ''
+    return path
+
+SHARED_CACHE_PATH = _private_shared_cache_path(os.environ.get('SHARED_CACHE_PATH', os.path.join(PRIVATE_CACHE_DIR, 'cache.sqlite3')))
+
+_shared_cache_local = threading.local()
+
 def get_random_headers():
     return {
         'User-Agent': random.choice(USER_AGENTS)
     }
 
-def get_edu_params(source='siawaseok'):
-    cache_duration = 300
-    current_time = time.time()
+class DeadlineExceeded(Exception):
+    pass
+
+def deadline_remaining():
+    deadline = _request_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+def upstream_timeout(timeout):
+    """上流呼び出しのタイムアウトをリクエストの残り時間に切り詰める"""
+    remaining = deadline_remaining()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise DeadlineExceeded()
+    if isinstance(timeout, tuple):
+        return tuple(min(t, remaining) for t in timeout)
+    return min(timeout, remaining)
+
+def submit_with_deadline(executor, fn, *args):
+    """呼び出し元のリクエスト期限を引き継いでスレッドプールに投入する"""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+def single_flight(key, fn, *args, **kwargs):
+    """同じキーで同時に実行中の上流リクエストがあれば、その結果を共有する"""
+    with _inflight_lock:
+        flight = _inflight_requests.get(key)
+        is_leader = flight is None
+        if is_leader:
+            flight = {'event': threading.Event(), 'result': None, 'error': None}
+            _inflight_requests[key] = flight
+
+    if not is_leader:
+        if not flight['event'].wait(deadline_remaining()):
+            raise DeadlineExceeded()
+        if flight['error'] is not None:
+            raise flight['error']
+        return flight['result']
+
+    try:
+        flight['result'] = fn(*args, **kwargs)
+        return flight['result']
+    except Exception as e:
+        flight['error'] = e
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight_requests.pop(key, None)
+        flight['event'].set()
+
+def stale_while_revalidate(key, ttl, fetch, *args):
+    """期限切れでも古い値をすぐに返し、裏で1スレッドだけが値を更新する
+    一度も取得に成功していない場合のみ同期的に取得し、失敗時はNoneを返す"""
+    with _swr_lock:
+        entry = _swr_cache.get(key)
+
+    if entry is None:
+        try:
+            return single_flight(('swr', key), _swr_refresh, key, fetch, args)
+        except DeadlineExceeded:
+            return None
+
+    if time.time() - entry['timestamp'] >= ttl:
+        with _swr_lock:
+            should_refresh = key not in _swr_refreshing
+            if should_refresh:
+                _swr_refreshing.add(key)
+        if should_refresh:
+            threading.Thread(target=_swr_background_refresh, args=(key, fetch, args), daemon=True).start()
+
+    return entry['value']
+
+def _swr_refresh(key, fetch, args):
+    value = fetch(*args)
+    if value:
+        with _swr_lock:
+            _swr_cache[key] = {'value': value, 'timestamp': time.time()}
+    return value
+
+def _swr_background_refresh(key, fetch, args):
+    try:
+        _swr_refresh(key, fetch, args)
+    except Exception as e:
+        print(f"Background refresh error ({key}): {e}")
+    finally:
+        with _swr_lock:
+            _swr_refreshing.discard(key)
+
+def _shared_cache_conn():
+    conn = getattr(_shared_cache_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(SHARED_CACHE_PATH, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS cache (namespace TEXT, key TEXT, value BLOB, expires_at REAL, PRIMARY KEY (namespace, key))')
+        conn.execute('CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, expires_at REAL)')
+        _shared_cache_local.conn = conn
+    return conn
+
+def shared_cache_get(namespace, key):
+    entry = shared_cache_lookup(namespace, key)
+    return entry[0] if entry else None
+
+def shared_cache_lookup(namespace, key):
+    """(値, 有効期限の時刻) を返す。なければNone"""
+    if not SHARED_CACHE_PATH:
+        return None
+    try:
+        row = _shared_cache_conn().execute(
+            'SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ? AND expires_at > ?',
+            (namespace, key, time.time())
+        ).fetchone()
+        return (pickle.loads(row[0]), row[1]) if row else None
+    except Exception as e:
+        print(f"Shared cache read error: {e}")
+        return None
+
+def shared_cache_set(namespace, key, value, ttl):
+    if not SHARED_CACHE_PATH:
+        return
+    try:
+        conn = _shared_cache_conn()
+        current_time = time.time()
+        conn.execute(
+            'INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+            (namespace, key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), current_time + ttl)
+        )
+        if random.random() < 0.01:
+            conn.execute('DELETE FROM cache WHERE expires_at <= ?', (current_time,))
+    except Exception as e:
+        print(f"Shared cache write error: {e}")
 
-    if source in _edu_params_cache and source in _edu_cache_timestamp:
-        if (current_time - _edu_cache_timestamp[source]) < cache_duration:
-            return _edu_params_cache[source]
+def _shared_cache_acquire_lease(name, ttl):
+    if not SHARED_CACHE_PATH:
+        return True
+    try:
+        conn = _shared_cache_conn()
+        current_time = time.time()
+        conn.execute('DELETE FROM leases WHERE name = ? AND expires_at <= ?', (name, current_time))
+        cursor = conn.execute('INSERT OR IGNORE INTO leases (name, expires_at) VALUES (?, ?)', (name, current_time + ttl))
+        return cursor.rowcount == 1
+    except Exception as e:
+        print(f"Shared cache lease error: {e}")
+        return True
 
+def _shared_cache_release_lease(name):
+    if not SHARED_CACHE_PATH:
+        return
+    try:
+        _shared_cache_conn().execute('DELETE FROM leases WHERE name = ?', (name,))
+    except:
+        pass
+
+def shared_cache_fetch(namespace, key, ttl, fetch, *args):
+    """共有キャッシュから取得し、なければホスト内で1つのワーカーだけがfetchを実行する"""
+    if not SHARED_CACHE_PATH:
+        return fetch(*args)
+
+    value = shared_cache_get(namespace, key)
+    if value is not None:
+        return value
+
+    lease_name = f"{namespace}:{key}"
+    if not _shared_cache_acquire_lease(lease_name, SHARED_CACHE_LEASE_WAIT * 2):
+        # 他のワーカーが取得中なので、結果が書き込まれるのを少し待つ
+        wait_until = time.time() + SHARED_CACHE_LEASE_WAIT
+        while time.time() < wait_until:
+            time.sleep(0.1)
+            value = shared_cache_get(namespace, key)
+            if value is not None:
+                return value
+        return fetch(*args)
+
+    try:
+        value = fetch(*args)
+        if value:
+            shared_cache_set(namespace, key, value, ttl)
+        return value
+    finally:
+        _shared_cache_release_lease(lease_name)
+
+def negative_cache_get(key):
+    with _negative_cache_lock:
+        entry = _negative_cache.get(key)
+        if entry is None:
+            return None
+        reason, expires_at = entry
+        if expires_at <= time.time():
+            del _negative_cache[key]
+            return None
+        return reason
+
+def negative_cache_set(key, reason):
+    with _negative_cache_lock:
+        _negative_cache.pop(key, None)
+        _negative_cache[key] = (reason, time.time() + NEGATIVE_CACHE_TTL[reason])
+        while len(_negative_cache) > NEGATIVE_CACHE_MAX_ENTRIES:
+            _negative_cache.popitem(last=False)
+
+def is_valid_video_id(video_id):
+    return bool(video_id) and VIDEO_ID_PATTERN.match(video_id) is not None
+
+def _metadata_cache_get(key):
+    global _metadata_cache_bytes
+    with _metadata_cache_lock:
+        entry = _metadata_cache.get(key)
+        if entry is None:
+            _metadata_cache_stats['misses'] += 1
+            return None
+        blob, expires_at = entry
+        if expires_at <= time.time():
+            del _metadata_cache[key]
+            _metadata_cache_bytes -= len(blob)
+            _metadata_cache_stats['misses'] += 1
+            return None
+        _metadata_cache.move_to_end(key)
+        _metadata_cache_stats['hits'] += 1
+        return blob
+
+def _metadata_cache_set(key, blob, ttl):
+    global _metadata_cache_bytes
+    if len(blob) > METADATA_CACHE_MAX_BYTES:
+        return
+    with _metadata_cache_lock:
+        old = _metadata_cache.pop(key, None)
+        if old is not None:
+            _metadata_cache_bytes -= len(old[0])
+        _metadata_cache[key] = (blob, time.time() + ttl)
+        _metadata_cache_bytes += len(blob)
+        while len(_metadata_cache) > METADATA_CACHE_MAX_ENTRIES or _metadata_cache_bytes > METADATA_CACHE_MAX_BYTES:
+            _, (evicted, _) = _metadata_cache.popitem(last=False)
+            _metadata_cache_bytes -= len(evicted)
+            _metadata_cache_stats['evictions'] += 1
+
+def cached_metadata(kind, shared=False):
+    """関数名と引数をキーに結果をキャッシュする。値はpickleで保持し、呼び出し側には毎回コピーを返す
+    shared=True の場合はワーカー間の共有キャッシュも参照する"""
+    def decorator(f):
+        signature = inspect.signature(f)
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = (f.__name__, tuple(bound.arguments.items()))
+            if negative_cache_get(('metadata', key)):
+                return None
+            blob = _metadata_cache_get(key)
+            if blob is None and shared:
+                entry = shared_cache_lookup('metadata', repr(key))
+                if entry is not None:
+                    # 他のワーカーが書き込んだ時点からの残り時間だけ保持する
+                    blob, expires_at = entry
+                    ttl = min(_metadata_ttl(kind, blob), expires_at - time.time())
+                    if ttl > 0:
+                        _metadata_cache_set(key, blob, ttl)
+            if blob is None:
+                try:
+                    blob = single_flight(('metadata', key), _fetch_metadata, f, key, kind, shared, bound.args, bound.kwargs)
+                except DeadlineExceeded:
+                    # 先行リクエストの完了を待つ前に期限が切れた場合も取得失敗と同じ扱いにする
+                    return None
+            return pickle.loads(blob) if blob is not None else None
+        return wrapper
+    return decorator
+
+def _fetch_metadata(f, key, kind, shared, args, kwargs):
+    _upstream_miss_reason.set(None)
+    value = f(*args, **kwargs)
+    if not value:
+        reason = _upstream_miss_reason.get()
+        if reason:
+            negative_cache_set(('metadata', key), reason)
+        return None
+    blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    ttl = _metadata_ttl(kind, blob, value)
+    if ttl > 0:
+        _metadata_cache_set(key, blob, ttl)
+        if shared:
+            shared_cache_set('metadata', repr(key), blob, ttl)
+    return blob
+
+def _metadata_ttl(kind, blob, value=None):
+    # TTLが関数の場合は値から決める (有効期限付きURLを含む結果など)
+    ttl = METADATA_CACHE_TTL[kind]
+    if callable(ttl):
+        return ttl(value if value is not None else pickle.loads(blob))
+    return ttl
+
+def _fetch_edu_params(source):
     source_config = EDU_PARAM_SOURCES.get(source, EDU_PARAM_SOURCES['siawaseok'])
     
     try:
-        res = http_session.get(source_config['url'], headers=get_random_headers(), timeout=3)
+        res = http_session.get(source_config['url'], headers=get_random_headers(), timeout=upstream_timeout(3))
         res.raise_for_status()
         
         if source_config['type'] == 'kahoot_key':
@@ -139,31 +587,215 @@ def get_edu_params(source='siawaseok'):
                 params = params[1:]
             params = params.replace('&amp;', '&')
         
-        _edu_params_cache[source] = params
-        _edu_cache_timestamp[source] = current_time
         return params
     except Exception as e:
         print(f"Failed to fetch edu params from {source}: {e}")
+        return None
+
+def get_edu_params(source='siawaseok'):
+    cache_duration = 300
+    params = stale_while_revalidate(('edu_params', source), cache_duration,
+                                    shared_cache_fetch, 'edu_params', source, cache_duration, _fetch_edu_params, source)
+    if params is None:
         return "autoplay=1&rel=0&modestbranding=1"
+    return params
 
-def safe_request(url, timeout=(2, 5)):
+def _safe_request(url, timeout):
     try:
-        res = http_session.get(url, headers=get_random_headers(), timeout=timeout)
+        res = http_session.get(url, headers=get_random_headers(), timeout=upstream_timeout(timeout))
         res.raise_for_status()
         return res.json()
     except:
         return None
 
-def request_invidious_api(path, timeout=(2, 5)):
-    random_instances = random.sample(INVIDIOUS_INSTANCES, min(3, len(INVIDIOUS_INSTANCES)))
-    for instance in random_instances:
+def safe_request(url, timeout=(2, 5)):
+    try:
+        return single_flight(('url', url), _safe_request, url, timeout)
+    except DeadlineExceeded:
+        return None
+
+def _get_instance_health(instance):
+    health = _instance_health.get(instance)
+    if health is None:
+        health = {
+            'successes': 0,
+            'failures': 0,
+            'success_rate': 1.0,
+            'latency': None,
+            'consecutive_failures': 0,
+            'open_until': 0
+        }
+        _instance_health[instance] = health
+    return health
+
+def record_instance_result(instance, success, latency=None):
+    with _instance_health_lock:
+        health = _get_instance_health(instance)
+        health['success_rate'] += INSTANCE_EWMA_ALPHA * ((1.0 if success else 0.0) - health['success_rate'])
+        if success:
+            health['successes'] += 1
+            health['consecutive_failures'] = 0
+            health['open_until'] = 0
+            if latency is not None:
+                if health['latency'] is None:
+                    health['latency'] = latency
+                else:
+                    health['latency'] += INSTANCE_EWMA_ALPHA * (latency - health['latency'])
+        else:
+            health['failures'] += 1
+            health['consecutive_failures'] += 1
+            excess = health['consecutive_failures'] - INSTANCE_FAILURE_THRESHOLD
+            if excess >= 0:
+                cooldown = min(INSTANCE_COOLDOWN * (2 ** min(excess, 5)), INSTANCE_MAX_COOLDOWN)
+                health['open_until'] = time.time() + cooldown
+
+def _instance_score(health):
+    latency = health['latency'] if health['latency'] is not None else 1.0
+    return latency / max(health['success_rate'], 0.05)
+
+def pick_invidious_instances(count):
+    """ヘルス情報をもとに、速くて生きているインスタンスを優先して返す"""
+    _ensure_instance_prober()
+    current_time = time.time()
+    with _instance_health_lock:
+        healths = {instance: dict(_get_instance_health(instance)) for instance in INVIDIOUS_INSTANCES}
+
+    candidates = [i for i in INVIDIOUS_INSTANCES if healths[i]['open_until'] <= current_time]
+    if not candidates:
+        # 全てのサーキットが開いている場合は、最も早くクールダウンが終わるものから試す
+        return sorted(INVIDIOUS_INSTANCES, key=lambda i: healths[i]['open_until'])[:count]
+
+    # 同程度のスコアのインスタンスに負荷を分散させるため、少し揺らぎを入れる
+    candidates.sort(key=lambda i: _instance_score(healths[i]) * random.uniform(0.8, 1.25))
+    return candidates[:count]
+
+def _probe_invidious_instances():
+    while True:
+        for instance in INVIDIOUS_INSTANCES:
+            start = time.time()
+            try:
+                res = http_session.get(instance + 'api/v1/stats', headers=get_random_headers(), timeout=(2, 4))
+                record_instance_result(instance, res.status_code == 200, time.time() - start)
+            except:
+                record_instance_result(instance, False)
+        time.sleep(INSTANCE_PROBE_INTERVAL)
+
+def _ensure_instance_prober():
+    global _instance_prober_started
+    if _instance_prober_started or INSTANCE_PROBE_INTERVAL <= 0:
+        return
+    with _instance_health_lock:
+        if _instance_prober_started:
+            return
+        _instance_prober_started = True
+    threading.Thread(target=_probe_invidious_instances, name='instance-prober', daemon=True).start()
+
+def _fetch_invidious_instance(instance, path, timeout, cancel_event):
+    if cancel_event.is_set():
+        return None
+    url = instance + 'api/v1' + path
+    start = time.time()
+    try:
+        res = http_session.get(url, headers=get_random_headers(), timeout=upstream_timeout(timeout), stream=True)
+    except:
+        if not cancel_event.is_set():
+            record_instance_result(instance, False)
+        raise
+    try:
+        # 404は「存在しない」という正常な応答なのでインスタンスの故障とはみなさない
+        if res.status_code not in (200, 404):
+            record_instance_result(instance, False)
+            return None
+        latency = time.time() - start
+        if res.status_code == 404:
+            record_instance_result(instance, True, latency)
+            return _INVIDIOUS_NOT_FOUND
+        if cancel_event.is_set():
+            return None
         try:
-            url = instance + 'api/v1' + path
-            res = http_session.get(url, headers=get_random_headers(), timeout=timeout)
-            if res.status_code == 200:
-                return res.json()
-        except:
-            continue
+            data = res.json()
+        except ValueError:
+            # 200でもHTMLのエラーページを返すインスタンスがあるので、JSONとして読めなければ故障とみなす
+            record_instance_result(instance, False)
+            return None
+        record_instance_result(instance, True, latency)
+        return data
+    finally:
+        res.close()
+
+def _record_invidious_miss(path, attempts, not_found):
+    remaining = deadline_remaining()
+    if attempts and not_found == attempts:
+        negative_cache_set(('invidious', path), 'not_found')
+    elif remaining is None or remaining > 0:
+        # リクエスト期限切れによる失敗は上流の障害ではないので記録しない
+        negative_cache_set(('invidious', path), 'failed')
+
+def request_invidious_api(path, timeout=(2, 5), fanout=None, hedge_delay=None):
+    """複数のInvidiousインスタンスへヘッジ送信し、最初に成功したレスポンスを返す"""
+    reason = negative_cache_get(('invidious', path))
+    if reason is None:
+        try:
+            data = single_flight(('invidious', path), _request_invidious_api, path, timeout, fanout, hedge_delay)
+        except DeadlineExceeded:
+            data = None
+        if data is not None:
+            return data
+        reason = negative_cache_get(('invidious', path))
+    _upstream_miss_reason.set(reason)
+    return None
+
+def _request_invidious_api(path, timeout, fanout, hedge_delay):
+    if fanout is None:
+        fanout = INVIDIOUS_FANOUT
+    if hedge_delay is None:
+        hedge_delay = 0 if INVIDIOUS_HEDGE_MODE == 'race' else INVIDIOUS_HEDGE_DELAY
+
+    instances = pick_invidious_instances(fanout)
+    attempts = len(instances)
+    not_found = 0
+    cancel_event = threading.Event()
+
+    if INVIDIOUS_HEDGE_MODE == 'sequential':
+        for instance in instances:
+            try:
+                data = _fetch_invidious_instance(instance, path, timeout, cancel_event)
+            except:
+                continue
+            if data is _INVIDIOUS_NOT_FOUND:
+                not_found += 1
+            elif data is not None:
+                return data
+        _record_invidious_miss(path, attempts, not_found)
+        return None
+
+    pending = set()
+    try:
+        while instances or pending:
+            if instances:
+                pending.add(submit_with_deadline(_upstream_executor, _fetch_invidious_instance, instances.pop(0), path, timeout, cancel_event))
+            remaining = deadline_remaining()
+            if remaining is not None and remaining <= 0:
+                break
+            wait_timeout = hedge_delay if instances else None
+            if remaining is not None:
+                wait_timeout = remaining if wait_timeout is None else min(wait_timeout, remaining)
+            done, pending = wait(pending, timeout=wait_timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    data = future.result()
+                except:
+                    data = None
+                if data is _INVIDIOUS_NOT_FOUND:
+                    not_found += 1
+                elif data is not None:
+                    return data
+    finally:
+        # 残りのリクエストはキャンセル（未開始なら破棄、実行中ならボディを読まずに切断）
+        cancel_event.set()
+        for future in pending:
+            future.cancel()
+    _record_invidious_miss(path, attempts, not_found)
     return None
 
 def get_youtube_search(query, max_results=20, use_api_keys=True):
@@ -175,7 +807,7 @@ def get_youtube_search(query, max_results=20, use_api_keys=True):
             api_key = YOUTUBE_API_KEYS[key_index]
             url = f"https://www.googleapis.com/youtube/v3/search?part=snippet&type=video&q={urllib.parse.quote(query)}&maxResults={max_results}&key={api_key}"
             try:
-                res = http_session.get(url, timeout=5)
+                res = http_session.get(url, timeout=upstream_timeout(5))
                 if res.status_code == 403:
                     print(f"YouTube API key {key_index + 1} quota exceeded, trying next...")
                     continue
@@ -221,7 +853,7 @@ def get_invidious_search_first(query, max_results=20):
             api_key = YOUTUBE_API_KEYS[key_index]
             url = f"https://www.googleapis.com/youtube/v3/search?part=snippet&type=video&q={urllib.parse.quote(query)}&maxResults={max_results}&key={api_key}"
             try:
-                res = http_session.get(url, timeout=5)
+                res = http_session.get(url, timeout=upstream_timeout(5))
                 if res.status_code == 403:
                     print(f"YouTube API key {key_index + 1} quota exceeded, trying next...")
                     continue
@@ -297,13 +929,18 @@ def invidious_search(query, page=1):
 
     return results
 
+@cached_metadata('video', shared=True)
 def get_video_info(video_id):
+    if not is_valid_video_id(video_id):
+        _upstream_miss_reason.set('not_found')
+        return None
+
     path = f"/videos/{urllib.parse.quote(video_id)}"
     data = request_invidious_api(path, timeout=(5, 15))
 
     if not data:
         try:
-            res = http_session.get(f"{EDU_VIDEO_API}{video_id}", headers=get_random_headers(), timeout=(2, 6))
+            res = http_session.get(f"{EDU_VIDEO_API}{video_id}", headers=get_random_headers(), timeout=upstream_timeout((2, 6)))
             res.raise_for_status()
             edu_data = res.json()
 
@@ -397,8 +1034,10 @@ def get_video_info(video_id):
         'audioUrl': audio_url
     }
 
-def get_playlist_info(playlist_id):
-    path = f"/playlists/{urllib.parse.quote(playlist_id)}"
+@cached_metadata('playlist', shared=True)
+def get_playlist_page(playlist_id, page=1):
+    """プレイリストの1ページ分 (Invidiousのpage=N) を取得する。動画には先頭からの通し番号indexを付ける"""
+    path = f"/playlists/{urllib.parse.quote(playlist_id)}?page={page}"
     data = request_invidious_api(path, timeout=(5, 15))
 
     if not data:
@@ -410,6 +1049,7 @@ def get_playlist_info(playlist_id):
         videos.append({
             'type': 'video',
             'id': item.get('videoId', ''),
+            'index': item.get('index'),
             'title': item.get('title', ''),
             'author': item.get('author', ''),
             'authorId': item.get('authorId', ''),
@@ -428,6 +1068,113 @@ def get_playlist_info(playlist_id):
         'videos': videos
     }
 
+def _get_playlist_entry(playlist_id):
+    now = time.time()
+    with _playlist_store_lock:
+        entry = _playlist_store.get(playlist_id)
+        if entry is not None and entry['expires'] > now:
+            _playlist_store.move_to_end(playlist_id)
+            return entry
+        entry = {
+            'info': None,
+            'videos': [],
+            'indices': [],
+            'next_page': 1,
+            'expires': now + METADATA_CACHE_TTL['playlist'],
+            'lock': threading.Lock()
+        }
+        _playlist_store[playlist_id] = entry
+        while len(_playlist_store) > PLAYLIST_STORE_MAX_ENTRIES:
+            _playlist_store.popitem(last=False)
+        return entry
+
+def _load_playlist_videos(playlist_id, index, after):
+    """通し番号indexの動画とその後ろafter件が揃うまでページを順に読み込み、通し番号順の一覧を保持する
+    削除・非公開の動画があると通し番号は飛ぶので、一覧の位置ではなく番号で探す"""
+    entry = _get_playlist_entry(playlist_id)
+    with entry['lock']:
+        videos = entry['videos']
+        indices = entry['indices']
+        while entry['next_page'] and len(videos) - bisect.bisect_right(indices, index) < after:
+            try:
+                page = get_playlist_page(playlist_id, entry['next_page'])
+            except DeadlineExceeded:
+                break
+            if page is None:
+                break
+            if entry['info'] is None:
+                entry['info'] = {k: v for k, v in page.items() if k != 'videos'}
+            added = 0
+            for video in page['videos']:
+                # ページ境界で重複して返る動画は最後に追加した通し番号と比べて除外する
+                last_index = indices[-1] if indices else -1
+                if video['index'] is None:
+                    video['index'] = last_index + 1
+                elif video['index'] <= last_index:
+                    continue
+                videos.append(video)
+                indices.append(video['index'])
+                added += 1
+            total = entry['info'].get('videoCount') or 0
+            if added == 0 or (total and len(videos) >= total) or len(videos) >= PLAYLIST_MAX_VIDEOS:
+                entry['next_page'] = None
+            else:
+                entry['next_page'] += 1
+        return entry
+
+def _playlist_total(entry):
+    total = entry['info'].get('videoCount') or 0
+    if entry['indices']:
+        total = max(total, entry['indices'][-1] + 1)
+    return total
+
+def get_playlist_window(playlist_id, index, before=None, after=None):
+    """現在の動画の前後だけをプレイリストの保存済み一覧から切り出して返す"""
+    before = PLAYLIST_WINDOW_BEFORE if before is None else before
+    after = PLAYLIST_WINDOW_AFTER if after is None else after
+    index = max(index, 0)
+    entry = _load_playlist_videos(playlist_id, index, after)
+    if entry['info'] is None:
+        return None
+
+    with entry['lock']:
+        position = bisect.bisect_left(entry['indices'], index)
+        end = bisect.bisect_right(entry['indices'], index) + after
+        videos = entry['videos'][max(position - before, 0):end]
+    return {
+        'title': entry['info'].get('title', ''),
+        'videos': videos,
+        'total': _playlist_total(entry)
+    }
+
+def get_playlist_info(playlist_id):
+    """プレイリストページ用に先頭から1ウィンドウ分だけを読み込む (総数はvideoCount)"""
+    count = PLAYLIST_WINDOW_BEFORE + PLAYLIST_WINDOW_AFTER
+    entry = _load_playlist_videos(playlist_id, -1, count)
+    if entry['info'] is None:
+        return None
+    with entry['lock']:
+        videos = entry['videos'][:count]
+    return dict(entry['info'], videos=videos, videoCount=_playlist_total(entry))
+
+def prefetch_watch_data(video_id, edu_source='siawaseok'):
+    """次に再生される動画の情報とストリームURLを先に取得してキャッシュに載せる"""
+    try:
+        get_video_info(video_id)
+        get_stream_url(video_id, edu_source)
+    except Exception as e:
+        print(f"Prefetch error for {video_id}: {e!r}")
+
+def _load_watch_playlist(playlist_id, index, edu_source):
+    window = get_playlist_window(playlist_id, index)
+    if window:
+        for video in window['videos']:
+            if video['index'] > index:
+                _page_executor.submit(prefetch_watch_data, video['id'], edu_source)
+                break
+    return window
+
+@cached_metadata('channel', shared=True)
 def get_channel_info(channel_id):
     path = f"/channels/{urllib.parse.quote(channel_id)}"
     data = request_invidious_api(path, timeout=(5, 15))
@@ -468,6 +1215,7 @@ def get_channel_info(channel_id):
         'videoCount': data.get('videoCount', 0)
     }
 
+@cached_metadata('channel_videos')
 def get_channel_videos(channel_id, continuation=None):
     path = f"/channels/{urllib.parse.quote(channel_id)}/videos"
     if continuation:
@@ -497,9 +1245,9 @@ def get_channel_videos(channel_id, continuation=None):
         'continuation': data.get('continuation', '')
     }
 
-def get_stream_url(video_id, edu_source='siawaseok'):
+def _default_stream_urls(video_id, edu_source='siawaseok'):
     edu_params = get_edu_params(edu_source)
-    urls = {
+    return {
         'primary': None,
         'fallback': None,
         'm3u8': None,
@@ -507,44 +1255,94 @@ def get_stream_url(video_id, edu_source='siawaseok'):
         'education': f"https://www.youtubeeducation.com/embed/{video_id}?{edu_params}"
     }
 
+STREAM_URL_EXPIRE_MARGIN = 300
+STREAM_URL_DEFAULT_TTL = 300
+_EXPIRE_PATTERN = re.compile(r'[?&/]expire[=/](\d+)')
+
+def _stream_urls_ttl(sources):
+    """googlevideoのURLに含まれるexpireのうち、最も早いものの少し前までをTTLとする"""
+    expires = []
+    for url in sources.values():
+        match = _EXPIRE_PATTERN.search(url or '')
+        if match:
+            expires.append(int(match.group(1)))
+    if not expires:
+        return STREAM_URL_DEFAULT_TTL
+    return min(expires) - STREAM_URL_EXPIRE_MARGIN - time.time()
+
+def _fetch_stream_sources(video_id):
+    sources = {'primary': None, 'fallback': None, 'm3u8': None}
+
+    stream_future = submit_with_deadline(_upstream_executor, safe_request, f"{STREAM_API}{video_id}", (3, 6))
+    m3u8_future = submit_with_deadline(_upstream_executor, safe_request, f"{M3U8_API}{video_id}", (3, 6))
+
     try:
-        res = http_session.get(f"{STREAM_API}{video_id}", headers=get_random_headers(), timeout=(3, 6))
-        if res.status_code == 200:
-            data = res.json()
+        data = stream_future.result()
+        if data:
             formats = data.get('formats', [])
 
             for fmt in formats:
                 if fmt.get('itag') == '18':
-                    urls['primary'] = fmt.get('url')
+                    sources['primary'] = fmt.get('url')
                     break
 
-            if not urls['primary']:
+            if not sources['primary']:
                 for fmt in formats:
                     if fmt.get('url') and fmt.get('vcodec') != 'none':
-                        urls['fallback'] = fmt.get('url')
+                        sources['fallback'] = fmt.get('url')
                         break
     except:
         pass
 
     try:
-        res = http_session.get(f"{M3U8_API}{video_id}", headers=get_random_headers(), timeout=(3, 6))
-        if res.status_code == 200:
-            data = res.json()
+        data = m3u8_future.result()
+        if data:
             m3u8_formats = data.get('m3u8_formats', [])
             if m3u8_formats:
                 best = max(m3u8_formats, key=lambda x: int(x.get('resolution', '0x0').split('x')[-1] or 0))
-                urls['m3u8'] = best.get('url')
+                sources['m3u8'] = best.get('url')
     except:
         pass
 
+    if any(sources.values()):
+        ttl = _stream_urls_ttl(sources)
+        if ttl > 0:
+            _metadata_cache_set(('stream_sources', video_id), pickle.dumps(sources), ttl)
+    return sources
+
+def get_stream_sources(video_id):
+    """STREAM_APIとM3U8_APIを並列に問い合わせ、URLの有効期限が切れる少し前までキャッシュする"""
+    blob = _metadata_cache_get(('stream_sources', video_id))
+    if blob is not None:
+        return pickle.loads(blob)
+    try:
+        return dict(single_flight(('stream_sources', video_id), _fetch_stream_sources, video_id))
+    except DeadlineExceeded:
+        return {'primary': None, 'fallback': None, 'm3u8': None}
+
+def get_stream_url(video_id, edu_source='siawaseok'):
+    urls = _default_stream_urls(video_id, edu_source)
+
+    if not is_valid_video_id(video_id):
+        return urls
+
+    urls.update(get_stream_sources(video_id))
     return urls
 
-def get_comments(video_id):
+@cached_metadata('comments')
+def get_comments_page(video_id, continuation=''):
+    """コメントを1ページ分取得する。continuationは次のページのトークン"""
+    if not is_valid_video_id(video_id):
+        return None
+
     path = f"/comments/{urllib.parse.quote(video_id)}?hl=jp"
+    if continuation:
+        path += f"&continuation={urllib.parse.quote(continuation)}"
     data = request_invidious_api(path)
 
     if not data:
-        return []
+        # 失敗をキャッシュさせないようNoneを返す (空の断片は呼び出し側で描画する)
+        return None
 
     comments = []
     for item in data.get('comments', []):
@@ -559,15 +1357,9 @@ def get_comments(video_id):
             'published': item.get('publishedText', '')
         })
 
-    return comments
-
-def get_trending():
-    cache_duration = 300
-    current_time = time.time()
-
-    if _trending_cache['data'] and (current_time - _trending_cache['timestamp']) < cache_duration:
-        return _trending_cache['data']
+    return {'comments': comments, 'continuation': data.get('continuation', '') or ''}
 
+def _fetch_trending():
     path = "/popular"
     data = request_invidious_api(path, timeout=(2, 4))
 
@@ -585,9 +1377,15 @@ def get_trending():
                     'views': item.get('viewCountText', '')
                 })
         if results:
-            _trending_cache['data'] = results
-            _trending_cache['timestamp'] = current_time
             return results
+    return None
+
+def get_trending():
+    cache_duration = 300
+    results = stale_while_revalidate('trending', cache_duration,
+                                     shared_cache_fetch, 'trending', 'popular', cache_duration, _fetch_trending)
+    if results:
+        return results
 
     default_videos = [
         {'type': 'video', 'id': 'dQw4w9WgXcQ', 'title': 'Rick Astley - Never Gonna Give You Up', 'author': 'Rick Astley', 'thumbnail': 'https://i.ytimg.com/vi/dQw4w9WgXcQ/hqdefault.jpg', 'published': '', 'views': '17億 回視聴'},
@@ -599,12 +1397,13 @@ def get_trending():
         {'type': 'video', 'id': 'XqZsoesa55w', 'title': 'Baby Shark Dance', 'author': 'Pinkfong', 'thumbnail': 'https://i.ytimg.com/vi/XqZsoesa55w/hqdefault.jpg', 'published': '', 'views': '150億 回視聴'},
         {'type': 'video', 'id': 'fJ9rUzIMcZQ', 'title': 'Queen - Bohemian Rhapsody', 'author': 'Queen Official', 'thumbnail': 'https://i.ytimg.com/vi/fJ9rUzIMcZQ/hqdefault.jpg', 'published': '', 'views': '16億 回視聴'},
     ]
+    mark_page_degraded()
     return default_videos
 
 def get_suggestions(keyword):
     try:
         url = f"https://suggestqueries.google.com/complete/search?client=firefox&ds=yt&q={urllib.parse.quote(keyword)}"
-        res = http_session.get(url, headers=get_random_headers(), timeout=2)
+        res = http_session.get(url, headers=get_random_headers(), timeout=upstream_timeout(2))
         if res.status_code == 200:
             data = res.json()
             return data[1] if len(data) > 1 else []
@@ -612,6 +1411,212 @@ def get_suggestions(keyword):
         pass
     return []
 
+def _wait_page_future(name, future, timeout):
+    try:
+        return future.result(timeout=max(timeout, 0))
+    except Exception as e:
+        future.cancel()
+        print(f"Watch page {name} load error: {e!r}")
+        return None
+
+class DeferredValue:
+    """テンプレートから最初に参照された時点で取得結果を待つ値"""
+
+    def __init__(self, resolver, futures=()):
+        self._resolver = resolver
+        self._futures = futures
+        self._resolved = False
+        self._value = None
+
+    def ready(self):
+        return self._resolved or all(future.done() for future in self._futures)
+
+    def resolve(self):
+        if not self._resolved:
+            self._value = self._resolver()
+            self._resolved = True
+        return self._value
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.resolve(), name)
+
+    def __getitem__(self, key):
+        return self.resolve()[key]
+
+    def __iter__(self):
+        return iter(self.resolve() or ())
+
+    def __len__(self):
+        return len(self.resolve() or ())
+
+    def __bool__(self):
+        return bool(self.resolve())
+
+    def __str__(self):
+        return str(self.resolve())
+
+def page_deadline(timeout=None):
+    """ページ描画の待ち時間の期限 (リクエスト全体の残り時間を超えない)"""
+    now = time.time()
+    remaining = deadline_remaining()
+    if timeout is None:
+        return now + (remaining if remaining is not None else DEFAULT_REQUEST_BUDGET)
+    if remaining is not None:
+        return now + min(timeout, remaining)
+    return now + timeout
+
+def deferred_future(name, future, deadline, default=None):
+    def resolver():
+        value = _wait_page_future(name, future, deadline - time.time())
+        if value is None:
+            mark_page_degraded()
+            if default is not None:
+                return default()
+        return value
+    return DeferredValue(resolver, (future,))
+
+def start_watch_page_loads(video_id, playlist_id='', edu_source='siawaseok', playlist_index=0):
+    """視聴ページに必要なデータの取得を並列に開始し、遅延値として返す
+    プレイリストは期限内に揃わなければ空にして、ページの表示を遅らせない (コメントは表示後に/commentsから読み込む)"""
+    deadline = page_deadline(WATCH_PAGE_TIMEOUT)
+    optional_deadline = min(time.time() + WATCH_OPTIONAL_TIMEOUT, deadline)
+    video_future = submit_with_deadline(_page_executor, get_video_info, video_id)
+    streams_future = submit_with_deadline(_page_executor, get_stream_url, video_id, edu_source)
+
+    data = {
+        'video': deferred_future('video', video_future, deadline),
+        'streams': deferred_future('streams', streams_future, deadline,
+                                   lambda: _default_stream_urls(video_id, edu_source)),
+        'playlist_videos': [],
+        'playlist_title': '',
+        'playlist_total': 0
+    }
+    if playlist_id:
+        playlist_future = submit_with_deadline(_page_executor, _load_watch_playlist, playlist_id, playlist_index, edu_source)
+        window = deferred_future('playlist', playlist_future, optional_deadline, dict)
+        data['playlist_videos'] = DeferredValue(lambda: window.resolve().get('videos', []), (playlist_future,))
+        data['playlist_title'] = DeferredValue(lambda: window.resolve().get('title', ''), (playlist_future,))
+        data['playlist_total'] = DeferredValue(lambda: window.resolve().get('total', 0), (playlist_future,))
+    return data
+
+def load_watch_page_data(video_id, playlist_id='', edu_source='siawaseok', playlist_index=0):
+    """視聴ページに必要なデータを並列に取得し、揃うまで待つ"""
+    data = start_watch_page_loads(video_id, playlist_id, edu_source, playlist_index)
+    return {name: value.resolve() if isinstance(value, DeferredValue) else value
+            for name, value in data.items()}
+
+def _stream_page_chunks(chunks, pending):
+    # 未取得の値が残っている間は生成した分をすぐ送り、揃った後はまとめて送る
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_FLUSH_SIZE or not all(value.ready() for value in pending):
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+
+def render_page(template_name, **context):
+    """遅延値を含むページを描画する。STREAM_RENDERINGが有効なら逐次送信する"""
+    if not STREAM_RENDERING:
+        return render_template(template_name, **context)
+    pending = [value for value in context.values() if isinstance(value, DeferredValue)]
+    chunks = stream_template(template_name, streaming=True, **context)
+    return Response(_stream_page_chunks(chunks, pending), mimetype='text/html')
+
+# 描画済みページのマイクロキャッシュ (ユーザーごとの違いはこれらのクッキーだけ)
+PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL', '30'))
+PAGE_CACHE_COOKIES = ('theme', 'vc', 'proxy')
+
+_page_renders = {}
+_page_renders_lock = threading.Lock()
+
+def mark_page_degraded():
+    """取得に失敗して代替の内容で描画したページをマイクロキャッシュに入れないようにする"""
+    if has_request_context():
+        state = g.get('page_cache_state')
+        if state is not None:
+            state['degraded'] = True
+
+def page_cache(ttl=PAGE_CACHE_TTL):
+    """ルート・引数・クッキーの組み合わせごとに描画結果のHTMLを短時間キャッシュする
+    同じページの描画中に来たリクエストは完了を待ってキャッシュから返す"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key = ('page', request.endpoint, request.path,
+                   tuple(sorted(request.args.items(multi=True))),
+                   tuple(request.cookies.get(name, '') for name in PAGE_CACHE_COOKIES))
+            html = _metadata_cache_get(key)
+            if html is not None:
+                return Response(html, mimetype='text/html')
+
+            with _page_renders_lock:
+                rendering = _page_renders.get(key)
+                if rendering is None:
+                    _page_renders[key] = threading.Event()
+            if rendering is None:
+                g.page_cache_state = {'degraded': False}
+                return _render_cached_page(f, key, ttl, args, kwargs, g.page_cache_state)
+
+            rendering.wait(deadline_remaining())
+            html = _metadata_cache_get(key)
+            if html is not None:
+                return Response(html, mimetype='text/html')
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _finish_page_render(key):
+    with _page_renders_lock:
+        rendering = _page_renders.pop(key, None)
+    if rendering is not None:
+        rendering.set()
+
+def _render_cached_page(f, key, ttl, args, kwargs, state):
+    try:
+        rv = f(*args, **kwargs)
+    except:
+        _finish_page_render(key)
+        raise
+
+    if isinstance(rv, str):
+        html = rv.encode('utf-8')
+        if not state['degraded']:
+            _metadata_cache_set(key, html, ttl)
+        _finish_page_render(key)
+        return Response(html, mimetype='text/html')
+    if isinstance(rv, Response) and rv.is_streamed:
+        # 逐次送信したチャンクを控えておき、最後まで送れたらキャッシュする
+        rv.response = _tee_page_stream(rv.response, key, ttl, state)
+        rv.call_on_close(lambda: _finish_page_render(key))
+        return rv
+    _finish_page_render(key)
+    return rv
+
+def _tee_page_stream(chunks, key, ttl, state):
+    body = []
+    for chunk in chunks:
+        body.append(chunk)
+        yield chunk
+    if not state['degraded']:
+        _metadata_cache_set(key, b''.join(body), ttl)
+    _finish_page_render(key)
+
+@app.before_request
+def warm_yt_dlp():
+    ensure_ydl_pool_warm()
+
+@app.before_request
+def start_request_deadline():
+    budget = REQUEST_BUDGETS.get(request.endpoint, DEFAULT_REQUEST_BUDGET)
+    _request_deadline.set(time.time() + budget if budget else None)
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if session.get('logged_in'):
@@ -636,6 +1641,7 @@ def index():
 
 @app.route('/trend')
 @login_required
+@page_cache()
 def trend():
     theme = request.cookies.get('theme', 'dark')
     trending = get_trending()
@@ -656,15 +1662,16 @@ def search():
 
     if page == '1':
         if search_mode == 'invidious':
-            results = get_invidious_search_first(query)
+            results_future = submit_with_deadline(_page_executor, get_invidious_search_first, query)
         else:
-            results = get_youtube_search(query)
+            results_future = submit_with_deadline(_page_executor, get_youtube_search, query)
     else:
-        results = invidious_search(query, int(page))
+        results_future = submit_with_deadline(_page_executor, invidious_search, query, int(page))
+    results = deferred_future('search', results_future, page_deadline(), list)
     
     next_page = f"/search?q={urllib.parse.quote(query)}&page={int(page) + 1}"
 
-    return render_template('search.html', results=results, query=query, vc=vc, proxy=proxy, theme=theme, next=next_page, search_mode=search_mode)
+    return render_page('search.html', results=results, query=query, vc=vc, proxy=proxy, theme=theme, next=next_page, search_mode=search_mode)
 
 @app.route('/watch')
 @login_required
@@ -678,30 +1685,25 @@ def watch():
     if not video_id:
         return render_template('index.html', videos=get_trending(), theme=theme)
 
-    video_info = get_video_info(video_id)
-    stream_urls = get_stream_url(video_id)
-    comments = get_comments(video_id)
-
-    playlist_videos = []
-    playlist_title = ''
-    if playlist_id:
-        playlist_info = get_playlist_info(playlist_id)
-        if playlist_info:
-            playlist_videos = playlist_info.get('videos', [])
-            playlist_title = playlist_info.get('title', '')
+    page_data = start_watch_page_loads(video_id, playlist_id, playlist_index=int(playlist_index))
+    video_info = page_data['video']
+    stream_urls = page_data['streams']
+    playlist_videos = page_data['playlist_videos']
+    playlist_title = page_data['playlist_title']
+    playlist_total = page_data['playlist_total']
 
-    return render_template('watch.html',
+    return render_page('watch.html',
                          video_id=video_id,
                          video=video_info,
                          streams=stream_urls,
-                         comments=comments,
                          mode='stream',
                          theme=theme,
                          proxy=proxy,
                          playlist_id=playlist_id,
                          playlist_index=int(playlist_index),
                          playlist_videos=playlist_videos,
-                         playlist_title=playlist_title)
+                         playlist_title=playlist_title,
+                         playlist_total=playlist_total)
 
 @app.route('/w')
 @login_required
@@ -715,30 +1717,25 @@ def watch_high_quality():
     if not video_id:
         return render_template('index.html', videos=get_trending(), theme=theme)
 
-    video_info = get_video_info(video_id)
-    stream_urls = get_stream_url(video_id)
-    comments = get_comments(video_id)
-
-    playlist_videos = []
-    playlist_title = ''
-    if playlist_id:
-        playlist_info = get_playlist_info(playlist_id)
-        if playlist_info:
-            playlist_videos = playlist_info.get('videos', [])
-            playlist_title = playlist_info.get('title', '')
+    page_data = load_watch_page_data(video_id, playlist_id, playlist_index=int(playlist_index))
+    video_info = page_data['video']
+    stream_urls = page_data['streams']
+    playlist_videos = page_data['playlist_videos']
+    playlist_title = page_data['playlist_title']
+    playlist_total = page_data['playlist_total']
 
     return render_template('watch.html',
                          video_id=video_id,
                          video=video_info,
                          streams=stream_urls,
-                         comments=comments,
                          mode='high',
                          theme=theme,
                          proxy=proxy,
                          playlist_id=playlist_id,
                          playlist_index=int(playlist_index),
                          playlist_videos=playlist_videos,
-                         playlist_title=playlist_title)
+                         playlist_title=playlist_title,
+                         playlist_total=playlist_total)
 
 @app.route('/ume')
 @login_required
@@ -752,30 +1749,25 @@ def watch_embed():
     if not video_id:
         return render_template('index.html', videos=get_trending(), theme=theme)
 
-    video_info = get_video_info(video_id)
-    stream_urls = get_stream_url(video_id)
-    comments = get_comments(video_id)
-
-    playlist_videos = []
-    playlist_title = ''
-    if playlist_id:
-        playlist_info = get_playlist_info(playlist_id)
-        if playlist_info:
-            playlist_videos = playlist_info.get('videos', [])
-            playlist_title = playlist_info.get('title', '')
+    page_data = load_watch_page_data(video_id, playlist_id, playlist_index=int(playlist_index))
+    video_info = page_data['video']
+    stream_urls = page_data['streams']
+    playlist_videos = page_data['playlist_videos']
+    playlist_title = page_data['playlist_title']
+    playlist_total = page_data['playlist_total']
 
     return render_template('watch.html',
                          video_id=video_id,
                          video=video_info,
                          streams=stream_urls,
-                         comments=comments,
                          mode='embed',
                          theme=theme,
                          proxy=proxy,
                          playlist_id=playlist_id,
                          playlist_index=int(playlist_index),
                          playlist_videos=playlist_videos,
-                         playlist_title=playlist_title)
+                         playlist_title=playlist_title,
+                         playlist_total=playlist_total)
 
 @app.route('/edu')
 @login_required
@@ -790,23 +1782,17 @@ def watch_education():
     if not video_id:
         return render_template('index.html', videos=get_trending(), theme=theme)
 
-    video_info = get_video_info(video_id)
-    stream_urls = get_stream_url(video_id, edu_source)
-    comments = get_comments(video_id)
-
-    playlist_videos = []
-    playlist_title = ''
-    if playlist_id:
-        playlist_info = get_playlist_info(playlist_id)
-        if playlist_info:
-            playlist_videos = playlist_info.get('videos', [])
-            playlist_title = playlist_info.get('title', '')
+    page_data = load_watch_page_data(video_id, playlist_id, edu_source, int(playlist_index))
+    video_info = page_data['video']
+    stream_urls = page_data['streams']
+    playlist_videos = page_data['playlist_videos']
+    playlist_title = page_data['playlist_title']
+    playlist_total = page_data['playlist_total']
 
     return render_template('watch.html',
                          video_id=video_id,
                          video=video_info,
                          streams=stream_urls,
-                         comments=comments,
                          mode='education',
                          theme=theme,
                          proxy=proxy,
@@ -814,27 +1800,37 @@ def watch_education():
                          playlist_index=int(playlist_index),
                          playlist_videos=playlist_videos,
                          playlist_title=playlist_title,
+                         playlist_total=playlist_total,
                          edu_source=edu_source,
                          edu_sources=EDU_PARAM_SOURCES)
 
 @app.route('/channel/<channel_id>')
 @login_required
+@page_cache()
 def channel(channel_id):
     theme = request.cookies.get('theme', 'dark')
     vc = request.cookies.get('vc', '1')
     proxy = request.cookies.get('proxy', 'False')
 
-    channel_info = get_channel_info(channel_id)
-
-    if not channel_info:
-        return render_template('channel.html', channel=None, videos=[], theme=theme, vc=vc, proxy=proxy, channel_id=channel_id, continuation='', total_videos=0)
-
-    channel_videos = get_channel_videos(channel_id)
-    videos = channel_videos.get('videos', []) if channel_videos else channel_info.get('videos', [])
-    continuation = channel_videos.get('continuation', '') if channel_videos else ''
-    total_videos = channel_info.get('videoCount', 0)
-
-    return render_template('channel.html',
+    deadline = page_deadline()
+    info_future = submit_with_deadline(_page_executor, get_channel_info, channel_id)
+    videos_future = submit_with_deadline(_page_executor, get_channel_videos, channel_id)
+    channel_info = deferred_future('channel', info_future, deadline, dict)
+    channel_videos = deferred_future('channel_videos', videos_future, deadline, dict)
+    futures = (info_future, videos_future)
+
+    def resolve_videos():
+        if not channel_info:
+            return []
+        if channel_videos:
+            return channel_videos.get('videos', [])
+        return channel_info.get('videos', [])
+
+    videos = DeferredValue(resolve_videos, futures)
+    continuation = DeferredValue(lambda: channel_videos.get('continuation', '') if channel_info else '', futures)
+    total_videos = DeferredValue(lambda: channel_info.get('videoCount', 0), (info_future,))
+
+    return render_page('channel.html',
                          channel=channel_info,
                          videos=videos,
                          theme=theme,
@@ -937,7 +1933,7 @@ def api_download(video_id):
                 "Accept": "application/json",
                 "Content-Type": "application/json"
             }
-            res = http_session.post(download_url, json=payload, headers=headers, timeout=10)
+            res = http_session.post(download_url, json=payload, headers=headers, timeout=upstream_timeout(10))
             if res.status_code == 200:
                 data = res.json()
                 if data.get('url'):
@@ -961,7 +1957,7 @@ def api_download(video_id):
                 "Accept": "application/json",
                 "Content-Type": "application/json"
             }
-            res = http_session.post(download_url, json=payload, headers=headers, timeout=10)
+            res = http_session.post(download_url, json=payload, headers=headers, timeout=upstream_timeout(10))
             if res.status_code == 200:
                 data = res.json()
                 if data.get('url'):
@@ -981,18 +1977,92 @@ def sanitize_filename(filename):
         filename = filename[:100]
     return filename
 
-def cleanup_old_downloads():
+# ダウンロード済みファイルのキャッシュ ((動画ID, 形式, 画質) ごとに1ファイル)
+# 使用時に更新時刻を更新し、保存時に古いものから容量上限まで削除する (LRU)
+# サイドカーのJSONが指すファイルをそのまま送信するので、置き場所は自分専用のディレクトリに限る (使えない場合は空文字でキャッシュしない)
+DOWNLOAD_CACHE_DIR = _private_directory(os.environ.get('DOWNLOAD_CACHE_DIR', os.path.join(PRIVATE_CACHE_DIR, 'downloads')), 'Download cache')
+DOWNLOAD_CACHE_MAX_BYTES = int(os.environ.get('DOWNLOAD_CACHE_MAX_BYTES', str(2 * 1024 * 1024 * 1024)))
+
+_download_cache_lock = threading.Lock()
+
+def download_cache_key(video_id, format_type, quality):
+    """キャッシュキーを正規化する (mp3は画質に依存しない)"""
+    if format_type == 'mp3':
+        return (video_id, 'mp3', 'audio')
+    if not re.fullmatch(r'\d{1,4}', quality or ''):
+        quality = '720'
+    return (video_id, 'mp4', quality)
+
+def _download_cache_base(key):
+    return os.path.join(DOWNLOAD_CACHE_DIR, '_'.join(key))
+
+def download_cache_lookup(key):
+    """キャッシュ済みならファイル情報を返し、最終使用時刻を更新する"""
+    if not DOWNLOAD_CACHE_DIR:
+        return None
+    base = _download_cache_base(key)
+    meta_path = base + '.json'
     try:
-        current_time = time.time()
-        for f in os.listdir(DOWNLOAD_DIR):
-            if f.startswith('chocotube_') and (f.endswith('.mp4') or f.endswith('.mp3')):
-                filepath = os.path.join(DOWNLOAD_DIR, f)
-                if os.path.isfile(filepath):
-                    file_age = current_time - os.path.getmtime(filepath)
-                    if file_age > 600:
-                        os.remove(filepath)
-    except Exception as e:
-        print(f"Cleanup error: {e}")
+        with open(meta_path) as f:
+            meta = json.load(f)
+        # キャッシュディレクトリ内の、このキーのファイル以外は指させない
+        if not isinstance(meta['file'], str) or meta['file'] != os.path.basename(meta['file']) \
+                or not meta['file'].startswith(os.path.basename(base) + '.'):
+            return None
+        path = os.path.join(DOWNLOAD_CACHE_DIR, meta['file'])
+        os.utime(path)
+        os.utime(meta_path)
+    except (OSError, ValueError, KeyError):
+        return None
+    return {'path': path, 'filename': meta['filename'], 'mimetype': meta['mimetype']}
+
+def download_cache_put(key, src_path, title):
+    """ダウンロードしたファイルをキャッシュに移し、ファイル情報を返す"""
+    video_id, format_type, _ = key
+    if not DOWNLOAD_CACHE_DIR:
+        return {'path': src_path, 'filename': f"{title}.{format_type}", 'mimetype': _download_mimetype(format_type)}
+    ext = os.path.splitext(src_path)[1]
+    base = _download_cache_base(key)
+    path = base + ext
+    os.replace(src_path, path)
+    meta = {
+        'file': os.path.basename(path),
+        'filename': f"{title}.{format_type}",
+        'mimetype': _download_mimetype(format_type)
+    }
+    _write_file_atomic(base + '.json', json.dumps(meta, ensure_ascii=False).encode('utf-8'))
+    _evict_download_cache()
+    return {'path': path, 'filename': meta['filename'], 'mimetype': meta['mimetype']}
+
+def _evict_download_cache():
+    with _download_cache_lock:
+        try:
+            entries = []
+            total = 0
+            for entry in os.scandir(DOWNLOAD_CACHE_DIR):
+                if entry.name.endswith('.json') or entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total <= DOWNLOAD_CACHE_MAX_BYTES:
+                    break
+                try:
+                    os.remove(os.path.splitext(path)[0] + '.json')
+                except OSError:
+                    pass
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+        except Exception as e:
+            print(f"Download cache eviction error: {e}")
 
 def get_yt_dlp_base_opts(output_template, cookie_file=None):
     """YouTube bot対策を回避するための共通yt-dlpオプションを返す"""
@@ -1025,157 +2095,591 @@ def get_yt_dlp_base_opts(output_template, cookie_file=None):
         opts['cookiefile'] = cookie_file
     return opts
 
-def create_youtube_cookies(cookie_file):
-    """YouTube用のcookieファイルを作成する"""
-    cookies_content = """# Netscape HTTP Cookie File
-.youtube.com    TRUE    /       TRUE    2147483647      CONSENT PENDING+987
-.youtube.com    TRUE    /       TRUE    2147483647      SOCS    CAESEwgDEgk2MjQyNTI1NzkaAmphIAEaBgiA_LyuBg
-.youtube.com    TRUE    /       TRUE    2147483647      PREF    tz=Asia.Tokyo&hl=ja&gl=JP
-.youtube.com    TRUE    /       TRUE    2147483647      GPS     1
-.youtube.com    TRUE    /       TRUE    2147483647      YSC     DwKYllHNwuw
-.youtube.com    TRUE    /       TRUE    2147483647      VISITOR_INFO1_LIVE      random_visitor_id
-"""
-    with open(cookie_file, 'w') as f:
-        f.write(cookies_content)
+# yt_dlpは読み込みに時間がかかるので、ワーカー起動時ではなく初回使用時にimportする
+_yt_dlp_module = None
+_yt_dlp_import_lock = threading.Lock()
+
+def get_yt_dlp():
+    global _yt_dlp_module
+    if _yt_dlp_module is None:
+        with _yt_dlp_import_lock:
+            if _yt_dlp_module is None:
+                import yt_dlp
+                _yt_dlp_module = yt_dlp
+    return _yt_dlp_module
+
+# YouTube用のcookie (ファイルに書き出さず、各YoutubeDLのcookiejarへ直接入れる)
+YOUTUBE_COOKIES = [
+    ('CONSENT', 'PENDING+987'),
+    ('SOCS', 'CAESEwgDEgk2MjQyNTI1NzkaAmphIAEaBgiA_LyuBg'),
+    ('PREF', 'tz=Asia.Tokyo&hl=ja&gl=JP'),
+    ('GPS', '1'),
+    ('YSC', 'DwKYllHNwuw'),
+    ('VISITOR_INFO1_LIVE', 'random_visitor_id'),
+]
 
-@app.route('/api/internal-download/<video_id>')
-@login_required
-def api_internal_download(video_id):
-    format_type = request.args.get('format', 'mp4')
-    quality = request.args.get('quality', '720')
+def install_youtube_cookies(ydl):
+    for name, value in YOUTUBE_COOKIES:
+        ydl.cookiejar.set_cookie(http.cookiejar.Cookie(
+            0, name, value, None, False, '.youtube.com', True, True, '/', True,
+            True, 2147483647, False, None, None, {}
+        ))
+    return ydl
 
-    video_url = f"https://www.youtube.com/watch?v={video_id}"
+def new_youtube_dl(ydl_opts):
+    """cookieを設定済みのYoutubeDLを作る"""
+    return install_youtube_cookies(get_yt_dlp().YoutubeDL(ydl_opts))
 
-    cleanup_old_downloads()
+# 情報抽出用のYoutubeDLプール (エクストラクターやプレイヤーJSのキャッシュを使い回す)
+YDL_POOL_SIZE = int(os.environ.get('YDL_POOL_SIZE', '2'))
 
-    unique_id = f"{video_id}_{int(time.time())}"
-    cookie_file = os.path.join(DOWNLOAD_DIR, f'cookies_{unique_id}.txt')
+_ydl_pool = queue.LifoQueue()
+_ydl_pool_warming = False
+_ydl_pool_lock = threading.Lock()
 
+def _new_extract_ydl():
+    ydl = new_youtube_dl(get_yt_dlp_base_opts(os.path.join(DOWNLOAD_DIR, '%(id)s.%(ext)s')))
+    ydl.get_info_extractor('Youtube')
+    return ydl
+
+def acquire_ydl():
+    """プールから抽出用のYoutubeDLを借りる (空なら新しく作る)。使い終わったらrelease_ydlで返す"""
     try:
-        cookies_content = """# Netscape HTTP Cookie File
-.youtube.com    TRUE    /       TRUE    2147483647      CONSENT PENDING+987
-.youtube.com    TRUE    /       TRUE    2147483647      SOCS    CAESEwgDEgk2MjQyNTI1NzkaAmphIAEaBgiA_LyuBg
-.youtube.com    TRUE    /       TRUE    2147483647      PREF    tz=Asia.Tokyo&hl=ja&gl=JP
-.youtube.com    TRUE    /       TRUE    2147483647      GPS     1
-.youtube.com    TRUE    /       TRUE    2147483647      YSC     DwKYllHNwuw
-.youtube.com    TRUE    /       TRUE    2147483647      VISITOR_INFO1_LIVE      random_visitor_id
-"""
-        with open(cookie_file, 'w') as f:
-            f.write(cookies_content)
-
-        base_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'cookiefile': cookie_file,
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
-                'Accept-Language': 'ja-JP,ja;q=0.9,en-US;q=0.8,en;q=0.7',
-                'Accept-Encoding': 'gzip, deflate, br',
-                'Sec-Ch-Ua': '"Not_A Brand";v="8", "Chromium";v="120", "Google Chrome";v="120"',
-                'Sec-Ch-Ua-Mobile': '?0',
-                'Sec-Ch-Ua-Platform': '"Windows"',
-                'Sec-Fetch-Dest': 'document',
-                'Sec-Fetch-Mode': 'navigate',
-                'Sec-Fetch-Site': 'none',
-                'Sec-Fetch-User': '?1',
-                'Upgrade-Insecure-Requests': '1',
-            },
-            'socket_timeout': 60,
-            'retries': 5,
-            'extractor_args': {'youtube': {'player_client': ['android', 'web']}},
-            'age_limit': None,
-            'geo_bypass': True,
-            'geo_bypass_country': 'JP',
-        }
+        return _ydl_pool.get_nowait()
+    except queue.Empty:
+        return _new_extract_ydl()
 
-        if format_type == 'mp3':
-            output_path = os.path.join(DOWNLOAD_DIR, f'chocotube_{unique_id}.mp3')
-            ydl_opts = {
-                **base_opts,
-                'format': 'bestaudio[ext=m4a]/bestaudio/best',
-                'outtmpl': os.path.join(DOWNLOAD_DIR, f'chocotube_{unique_id}.%(ext)s'),
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-            }
-        else:
-            output_path = os.path.join(DOWNLOAD_DIR, f'chocotube_{unique_id}.mp4')
-            format_string = f'bestvideo[height<={quality}][ext=mp4]+bestaudio[ext=m4a]/bestvideo[height<={quality}]+bestaudio/best[height<={quality}]/best'
-            ydl_opts = {
-                **base_opts,
-                'format': format_string,
-                'outtmpl': os.path.join(DOWNLOAD_DIR, f'chocotube_{unique_id}.%(ext)s'),
-                'merge_output_format': 'mp4',
-            }
+def release_ydl(ydl):
+    if _ydl_pool.qsize() < YDL_POOL_SIZE:
+        _ydl_pool.put(ydl)
+    else:
+        ydl.close()
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=True)
-            title = sanitize_filename(info.get('title', video_id) if info else video_id)
+def _warm_ydl_pool():
+    try:
+        while _ydl_pool.qsize() < YDL_POOL_SIZE:
+            _ydl_pool.put(_new_extract_ydl())
+    except Exception as e:
+        print(f"yt-dlp pool warm-up error: {e}")
+
+def ensure_ydl_pool_warm():
+    global _ydl_pool_warming
+    if _ydl_pool_warming or YDL_POOL_SIZE <= 0:
+        return
+    with _ydl_pool_lock:
+        if _ydl_pool_warming:
+            return
+        _ydl_pool_warming = True
+    threading.Thread(target=_warm_ydl_pool, name='ydl-pool-warmer', daemon=True).start()
+
+@cached_metadata('ydl_info', shared=True)
+def extract_video_info(video_id):
+    """yt-dlpで動画情報を抽出し、JSON化できる形に整えた辞書を返す
+    音声URLの取得・ダウンロード・変換の各ルートで共有し、フォーマットURLの有効期限までキャッシュする"""
+    if not is_valid_video_id(video_id):
+        return None
 
-        if os.path.exists(cookie_file):
-            os.remove(cookie_file)
+    ydl = acquire_ydl()
+    try:
+        info = ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=False)
+        info = ydl.sanitize_info(info, remove_private_keys=True)
+    except:
+        # 失敗したインスタンスは状態が分からないのでプールに戻さず閉じる
+        ydl.close()
+        raise
+    release_ydl(ydl)
+    return info
+
+def _extract_info_ttl(info):
+    """フォーマットURLのexpireのうち、最も早いものの少し前までをTTLとする"""
+    expires = []
+    for fmt in info.get('formats') or []:
+        for url in (fmt.get('url'), fmt.get('manifest_url')):
+            match = _EXPIRE_PATTERN.search(url or '')
+            if match:
+                expires.append(int(match.group(1)))
+    if not expires:
+        return STREAM_URL_DEFAULT_TTL
+    return min(expires) - STREAM_URL_EXPIRE_MARGIN - time.time()
+
+def invalidate_video_info(video_id):
+    key = ('extract_video_info', (('video_id', video_id),))
+    with _metadata_cache_lock:
+        _metadata_cache.pop(key, None)
+    if SHARED_CACHE_PATH:
+        try:
+            _shared_cache_conn().execute('DELETE FROM cache WHERE namespace = ? AND key = ?', ('metadata', repr(key)))
+        except Exception as e:
+            print(f"Shared cache delete error: {e}")
+
+def ydl_download(video_id, ydl_opts):
+    """キャッシュ済みの抽出結果をprocess_ie_resultに渡してダウンロードし、情報辞書を返す
+    URLが失効していた場合はキャッシュを捨てて抽出からやり直す"""
+    info = extract_video_info(video_id)
+    with new_youtube_dl(ydl_opts) as ydl:
+        if info:
+            try:
+                return ydl.process_ie_result(info, download=True)
+            except get_yt_dlp().utils.DownloadError as e:
+                print(f"Download with cached info failed for {video_id}, re-extracting: {e}")
+                invalidate_video_info(video_id)
+        return ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=True)
+
+def _download_mimetype(format_type):
+    return 'audio/mpeg' if format_type == 'mp3' else 'video/mp4'
+
+def run_internal_download(video_id, format_type='mp4', quality='720', unique_id=None,
+                          progress_hooks=(), postprocessor_hooks=()):
+    """yt-dlpで動画(mp4)または音声(mp3)をDOWNLOAD_DIRに保存し、(ファイルパス, タイトル) を返す
+    失敗した場合は例外を送出する"""
+    unique_id = unique_id or f"{video_id}_{int(time.time())}"
+    output_template = os.path.join(DOWNLOAD_DIR, f'chocotube_{unique_id}.%(ext)s')
+
+    try:
+        ydl_opts = get_yt_dlp_base_opts(output_template)
+        ydl_opts['progress_hooks'] = list(progress_hooks)
+        ydl_opts['postprocessor_hooks'] = list(postprocessor_hooks)
 
         if format_type == 'mp3':
-            if os.path.exists(output_path):
-                return send_file(
-                    output_path,
-                    as_attachment=True,
-                    download_name=f"{title}.mp3",
-                    mimetype='audio/mpeg'
-                )
-            for ext in ['mp3', 'm4a', 'webm', 'opus']:
-                check_path = os.path.join(DOWNLOAD_DIR, f'chocotube_{unique_id}.{ext}')
-                if os.path.exists(check_path):
-                    return send_file(
-                        check_path,
-                        as_attachment=True,
-                        download_name=f"{title}.mp3",
-                        mimetype='audio/mpeg'
-                    )
+            ydl_opts['format'] = 'bestaudio[ext=m4a]/bestaudio/best'
+            ydl_opts['postprocessors'] = [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': '192',
+            }]
+            extensions = ['mp3', 'm4a', 'webm', 'opus']
         else:
-            if os.path.exists(output_path):
-                return send_file(
-                    output_path,
-                    as_attachment=True,
-                    download_name=f"{title}.mp4",
-                    mimetype='video/mp4'
+            ydl_opts['format'] = f'bestvideo[height<={quality}][ext=mp4]+bestaudio[ext=m4a]/bestvideo[height<={quality}]+bestaudio/best[height<={quality}]/best'
+            ydl_opts['merge_output_format'] = 'mp4'
+            extensions = ['mp4', 'mkv', 'webm']
+
+        info = ydl_download(video_id, ydl_opts)
+        title = sanitize_filename(info.get('title', video_id) if info else video_id)
+    except:
+        _remove_partial_downloads(unique_id)
+        raise
+
+    for ext in extensions:
+        check_path = os.path.join(DOWNLOAD_DIR, f'chocotube_{unique_id}.{ext}')
+        if os.path.exists(check_path):
+            return check_path, title
+    _remove_partial_downloads(unique_id)
+    raise Exception('ファイルのダウンロードに失敗しました')
+
+def _remove_partial_downloads(unique_id):
+    # 失敗したダウンロードの途中ファイル (.part や結合前の各ストリーム) を消す
+    for path in glob.glob(os.path.join(DOWNLOAD_DIR, glob.escape(f'chocotube_{unique_id}.') + '*')):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# バックグラウンドのダウンロードジョブ (閲覧リクエストのスレッドを塞がないよう専用のプールで実行する)
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', '2'))
+DOWNLOAD_QUEUE_MAX = int(os.environ.get('DOWNLOAD_QUEUE_MAX', '20'))
+DOWNLOAD_JOB_TTL = 1800
+DOWNLOAD_PROGRESS_INTERVAL = 0.5
+# SSEの1接続あたりの最長時間。リクエストスレッドを長く占有しないよう、切った後はEventSourceに再接続させる
+DOWNLOAD_EVENTS_MAX_DURATION = 5
+DOWNLOAD_EVENTS_RETRY_MS = 1000
+INTERNAL_DOWNLOAD_RETRY_AFTER = 5
+
+_download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix='download')
+_download_jobs = {}
+_download_inflight = {}
+_download_jobs_lock = threading.Lock()
+
+def _publish_download_job(job):
+    # 他のワーカーに届いた進捗確認リクエストからも見えるように共有キャッシュへ書き出す
+    shared_cache_set('download_job', job['id'], job, DOWNLOAD_JOB_TTL)
+
+def _update_download_job(job_id, **fields):
+    with _download_jobs_lock:
+        job = _download_jobs.get(job_id)
+        if job is None:
+            return
+        status_changed = fields.get('status', job['status']) != job['status']
+        job.update(fields)
+        now = time.time()
+        if not status_changed and now - job['updated'] < DOWNLOAD_PROGRESS_INTERVAL:
+            return
+        job['updated'] = now
+        snapshot = dict(job)
+    _publish_download_job(snapshot)
+
+def _download_progress_hook(job_id):
+    def hook(d):
+        if d.get('status') == 'downloading':
+            downloaded = d.get('downloaded_bytes') or 0
+            total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+            _update_download_job(job_id,
+                                 status='downloading',
+                                 downloaded_bytes=downloaded,
+                                 total_bytes=total,
+                                 progress=round(downloaded * 100 / total, 1) if total else None,
+                                 speed=d.get('speed'),
+                                 eta=d.get('eta'))
+    return hook
+
+def _download_postprocessor_hook(job_id):
+    def hook(d):
+        if d.get('status') == 'started':
+            _update_download_job(job_id, status='processing', progress=100)
+    return hook
+
+def _finish_download_job(job_id, entry):
+    _update_download_job(job_id, status='finished', progress=100, path=entry['path'],
+                         filename=entry['filename'], mimetype=entry['mimetype'])
+
+def _run_download_job(job_id, key, quality):
+    video_id, format_type, _ = key
+    lease_name = 'download:' + '_'.join(key)
+    try:
+        # 同じファイルを他のワーカーが作成中なら、完了してキャッシュに入るのを待つ
+        wait_until = time.time() + DOWNLOAD_JOB_TTL
+        while SHARED_CACHE_PATH and not _shared_cache_acquire_lease(lease_name, DOWNLOAD_JOB_TTL):
+            entry = download_cache_lookup(key)
+            if entry:
+                _finish_download_job(job_id, entry)
+                return
+            if time.time() > wait_until:
+                _update_download_job(job_id, status='error', error='ダウンロードがタイムアウトしました')
+                return
+            time.sleep(1)
+
+        try:
+            entry = download_cache_lookup(key)
+            if entry is None:
+                _update_download_job(job_id, status='downloading')
+                path, title = run_internal_download(
+                    video_id, format_type, quality,
+                    unique_id=f"{video_id}_{job_id}",
+                    progress_hooks=[_download_progress_hook(job_id)],
+                    postprocessor_hooks=[_download_postprocessor_hook(job_id)]
                 )
-            for ext in ['mp4', 'mkv', 'webm']:
-                check_path = os.path.join(DOWNLOAD_DIR, f'chocotube_{unique_id}.{ext}')
-                if os.path.exists(check_path):
-                    return send_file(
-                        check_path,
-                        as_attachment=True,
-                        download_name=f"{title}.mp4",
-                        mimetype='video/mp4'
-                    )
+                entry = download_cache_put(key, path, title)
+        except Exception as e:
+            print(f"Download job {job_id} error: {e}")
+            _update_download_job(job_id, status='error', error=f'ダウンロードエラー: {str(e)}')
+            return
+        finally:
+            if SHARED_CACHE_PATH:
+                _shared_cache_release_lease(lease_name)
+        _finish_download_job(job_id, entry)
+    finally:
+        with _download_jobs_lock:
+            if _download_inflight.get(key) == job_id:
+                del _download_inflight[key]
+
+def _prune_download_jobs():
+    expired_before = time.time() - DOWNLOAD_JOB_TTL
+    with _download_jobs_lock:
+        for job_id in [job_id for job_id, job in _download_jobs.items() if job['created'] < expired_before]:
+            del _download_jobs[job_id]
+
+def submit_download_job(video_id, format_type='mp4', quality='720'):
+    """ダウンロードジョブを登録してジョブ情報を返す。待ち行列が満杯ならNoneを返す
+    キャッシュ済みなら完了済みのジョブを返し、同じファイルを作成中ならそのジョブを返す"""
+    if not is_valid_video_id(video_id):
+        # 動画IDはyt-dlpに渡され、キャッシュのファイル名にもなる
+        raise ValueError(f"invalid video id: {video_id!r}")
+    _prune_download_jobs()
+    key = download_cache_key(video_id, format_type, quality)
+    entry = download_cache_lookup(key)
+    job_id = hashlib.sha1(f"{video_id}:{time.time()}:{random.random()}".encode()).hexdigest()[:16]
+    now = time.time()
+    job = {
+        'id': job_id,
+        'video_id': video_id,
+        'format': key[1],
+        'quality': key[2],
+        'status': 'queued',
+        'progress': 0,
+        'downloaded_bytes': 0,
+        'total_bytes': 0,
+        'speed': None,
+        'eta': None,
+        'error': None,
+        'path': None,
+        'filename': None,
+        'mimetype': None,
+        'created': now,
+        'updated': now
+    }
+    if entry:
+        job.update(status='finished', progress=100, path=entry['path'],
+                   filename=entry['filename'], mimetype=entry['mimetype'])
+
+    with _download_jobs_lock:
+        inflight = _download_jobs.get(_download_inflight.get(key))
+        if entry is None and inflight is not None:
+            return dict(inflight)
+        if entry is None:
+            active = sum(1 for j in _download_jobs.values() if j['status'] not in ('finished', 'error'))
+            if active >= DOWNLOAD_QUEUE_MAX:
+                return None
+        _download_jobs[job_id] = job
+        if entry is None:
+            _download_inflight[key] = job_id
+            _download_executor.submit(_run_download_job, job_id, key, quality)
+        snapshot = dict(job)
+    _publish_download_job(snapshot)
+    return snapshot
+
+def get_download_job(job_id):
+    with _download_jobs_lock:
+        job = _download_jobs.get(job_id)
+        if job is not None:
+            return dict(job)
+    return shared_cache_get('download_job', job_id)
+
+def _public_download_job(job):
+    public = {k: v for k, v in job.items() if k not in ('path', 'mimetype')}
+    public['success'] = job['status'] != 'error'
+    if job['status'] == 'finished':
+        public['file_url'] = url_for('api_download_job_file', job_id=job['id'])
+    return public
+
+def _send_download_file(job):
+    if not job.get('path') or not os.path.exists(job['path']):
+        return jsonify({'success': False, 'error': 'ファイルが見つかりません'}), 404
+    # conditional=True でRangeリクエストに応じ、中断したダウンロードを再開できるようにする
+    return send_file(job['path'], as_attachment=True, download_name=job['filename'],
+                     mimetype=job['mimetype'], conditional=True)
 
+@app.route('/api/internal-download/<video_id>')
+@login_required
+def api_internal_download(video_id):
+    """従来のAPI。このURLは常にファイルを返す (リクエストスレッドで完了を待たない)
+    作成中は202とRetry-Afterを返し、Locationのjob付きURLを再度取得すると完了後にファイルが返る"""
+    format_type = request.args.get('format', 'mp4')
+    quality = request.args.get('quality', '720')
+    job_id = request.args.get('job', '')
+
+    if not is_valid_video_id(video_id):
+        return jsonify({'success': False, 'error': '動画IDが正しくありません'}), 400
+    if job_id:
+        job = get_download_job(job_id)
+        if job is None:
+            return jsonify({'success': False, 'error': 'ジョブが見つかりません'}), 404
+    else:
+        job = submit_download_job(video_id, format_type, quality)
+        if job is None:
+            return jsonify({'success': False, 'error': 'ダウンロードが混み合っています。しばらくしてからお試しください'}), 503
+
+    if job['status'] == 'finished':
+        return _send_download_file(job)
+    if job['status'] == 'error':
         return jsonify({
             'success': False,
-            'error': 'ファイルのダウンロードに失敗しました'
+            'error': job.get('error') or 'ファイルのダウンロードに失敗しました'
         }), 500
 
+    retry_url = url_for('api_internal_download', video_id=video_id, format=format_type, quality=quality, job=job['id'])
+    response = jsonify({'success': False, 'status': job['status'], 'job_id': job['id'], 'retry_url': retry_url})
+    response.status_code = 202
+    response.headers['Retry-After'] = str(INTERNAL_DOWNLOAD_RETRY_AFTER)
+    response.headers['Location'] = retry_url
+    return response
+
+@app.route('/api/download-jobs/<video_id>', methods=['POST'])
+@login_required
+def api_submit_download_job(video_id):
+    format_type = request.args.get('format', 'mp4')
+    quality = request.args.get('quality', '720')
+
+    if not is_valid_video_id(video_id):
+        return jsonify({'success': False, 'error': '動画IDが正しくありません'}), 400
+
+    job = submit_download_job(video_id, format_type, quality)
+    if job is None:
+        return jsonify({'success': False, 'error': 'ダウンロードが混み合っています。しばらくしてからお試しください'}), 503
+    return _download_job_accepted(job)
+
+def _download_job_accepted(job):
+    return jsonify({
+        'success': True,
+        'job_id': job['id'],
+        'status_url': url_for('api_download_job_status', job_id=job['id']),
+        'events_url': url_for('api_download_job_events', job_id=job['id'])
+    }), 202
+
+@app.route('/api/download-jobs/<job_id>')
+@login_required
+def api_download_job_status(job_id):
+    job = get_download_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'ジョブが見つかりません'}), 404
+    return jsonify(_public_download_job(job))
+
+@app.route('/api/download-jobs/<job_id>/events')
+@login_required
+def api_download_job_events(job_id):
+    """ジョブの進捗をServer-Sent Eventsで送る
+    1接続はDOWNLOAD_EVENTS_MAX_DURATION秒で閉じ、EventSourceの自動再接続で続きを受け取らせる"""
+    if get_download_job(job_id) is None:
+        return jsonify({'success': False, 'error': 'ジョブが見つかりません'}), 404
+
+    def generate():
+        last_updated = None
+        yield f"retry: {DOWNLOAD_EVENTS_RETRY_MS}\n\n"
+        expires = time.time() + DOWNLOAD_EVENTS_MAX_DURATION
+        while time.time() < expires:
+            job = get_download_job(job_id)
+            if job is None:
+                break
+            if job['updated'] != last_updated:
+                last_updated = job['updated']
+                yield f"data: {json.dumps(_public_download_job(job), ensure_ascii=False)}\n\n"
+                if job['status'] in ('finished', 'error'):
+                    break
+            time.sleep(DOWNLOAD_PROGRESS_INTERVAL)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/download-jobs/<job_id>/file')
+@login_required
+def api_download_job_file(job_id):
+    job = get_download_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'ジョブが見つかりません'}), 404
+    if job['status'] != 'finished':
+        return jsonify({'success': False, 'error': 'ダウンロードはまだ完了していません', 'status': job['status']}), 409
+    return _send_download_file(job)
+
+# パイプ方式のダウンロード (一時ファイルを作らず、yt-dlp/ffmpegの出力をそのままチャンクで送る)
+# 1ファイルで完結する形式 (音声付きのmp4・m4a音声) と、ffmpegで変換するmp3のみ対応
+PIPE_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+PIPE_DOWNLOAD_FORMATS = {
+    'mp4': ('best[ext=mp4][height<={quality}][vcodec!=none][acodec!=none]/best[ext=mp4][vcodec!=none][acodec!=none]', 'video/mp4'),
+    'm4a': ('bestaudio[ext=m4a]/bestaudio', 'audio/mp4'),
+    'mp3': ('bestaudio', 'audio/mpeg'),
+}
+
+def _yt_dlp_cli_args():
+    """get_yt_dlp_base_opts と同じ設定でyt-dlpコマンドの引数を組み立てる"""
+    opts = get_yt_dlp_base_opts('-')
+    args = [
+        sys.executable, '-m', 'yt_dlp',
+        '--quiet', '--no-warnings', '--no-part', '--no-playlist',
+        '-o', '-',
+        '--socket-timeout', str(opts['socket_timeout']),
+        '--retries', str(opts['retries']),
+    ]
+    for name, value in opts['http_headers'].items():
+        args += ['--add-header', f'{name}:{value}']
+    return args
+
+def _stop_pipe_processes(processes, info_file):
+    for proc in processes:
+        if proc.poll() is None:
+            proc.kill()
+    for proc in processes:
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            pass
+    if info_file and os.path.exists(info_file):
+        try:
+            os.remove(info_file)
+        except:
+            pass
+
+def _pipe_download_body(first_chunk, processes):
+    # クライアントが読むまで次のチャンクを読まないので、パイプが詰まればyt-dlp側も待つ (背圧)
+    # プロセスの終了はレスポンスのclose (切断時も含む) で行う
+    out = processes[-1].stdout
+    yield first_chunk
+    while True:
+        chunk = out.read1(PIPE_DOWNLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+def _pipe_download_response(body, mimetype, title, format_type):
+    response = Response(body, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{urllib.parse.quote(title + '.' + format_type)}"
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/pipe-download/<video_id>')
+@login_required
+def api_pipe_download(video_id):
+    format_type = request.args.get('format', 'mp4')
+    quality = request.args.get('quality', '360')
+
+    if not is_valid_video_id(video_id):
+        return jsonify({'success': False, 'error': '動画IDが正しくありません'}), 400
+    if format_type not in PIPE_DOWNLOAD_FORMATS:
+        return jsonify({'success': False, 'error': f'{format_type}はこの方法では対応していません'}), 400
+    if format_type == 'mp3' and not shutil.which('ffmpeg'):
+        return jsonify({'success': False, 'error': 'ffmpegが利用できないためMP3に変換できません'}), 501
+    if not re.fullmatch(r'\d{1,4}', quality):
+        quality = '360'
+
+    # 抽出はキャッシュ済みの結果を使い、サブプロセスには --load-info-json で渡してダウンロードだけをさせる
+    try:
+        info = extract_video_info(video_id)
     except Exception as e:
-        print(f"Internal download error: {e}")
-        if os.path.exists(cookie_file):
-            try:
-                os.remove(cookie_file)
-            except:
-                pass
-        return jsonify({
-            'success': False,
-            'error': f'ダウンロードエラー: {str(e)}'
-        }), 500
+        print(f"Pipe download extract error for {video_id}: {e}")
+        return jsonify({'success': False, 'error': f'ダウンロードエラー: {str(e)}'}), 502
+    if not info:
+        return jsonify({'success': False, 'error': '動画情報を取得できませんでした'}), 502
+
+    format_string, mimetype = PIPE_DOWNLOAD_FORMATS[format_type]
+    title = sanitize_filename(info.get('title') or '') or video_id
+    if request.method == 'HEAD':
+        # ボディを送らないのでプロセスは起動しない
+        return _pipe_download_response(None, mimetype, title, format_type)
+
+    info_file = os.path.join(DOWNLOAD_DIR, f'chocotube_pipe_{video_id}_{threading.get_ident()}_{int(time.time() * 1000)}.info.json')
+    processes = []
+    try:
+        _write_file_atomic(info_file, json.dumps(info).encode('utf-8'))
+        args = _yt_dlp_cli_args() + ['-f', format_string.format(quality=quality), '--load-info-json', info_file]
+        processes.append(subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+        if format_type == 'mp3':
+            ffmpeg = subprocess.Popen(
+                ['ffmpeg', '-loglevel', 'error', '-i', 'pipe:0', '-vn', '-f', 'mp3', '-b:a', '192k', 'pipe:1'],
+                stdin=processes[0].stdout, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+            )
+            # ffmpegが終了したらyt-dlp側にもSIGPIPEが届くように親の参照を閉じる
+            processes[0].stdout.close()
+            processes.append(ffmpeg)
+
+        # 最初のチャンクが届くまで待ち、失敗した場合は空の200ではなくエラーを返す
+        first_chunk = processes[-1].stdout.read1(PIPE_DOWNLOAD_CHUNK_SIZE)
+    except Exception as e:
+        print(f"Pipe download error: {e}")
+        _stop_pipe_processes(processes, info_file)
+        return jsonify({'success': False, 'error': f'ダウンロードエラー: {str(e)}'}), 500
+
+    if not first_chunk:
+        error = ''
+        try:
+            processes[0].wait(timeout=5)
+            error = processes[0].stderr.read().decode('utf-8', 'replace').strip()
+        except Exception:
+            pass
+        _stop_pipe_processes(processes, info_file)
+        # URLが失効している可能性があるので、次回は抽出からやり直す
+        invalidate_video_info(video_id)
+        print(f"Pipe download error for {video_id}: {error}")
+        return jsonify({'success': False, 'error': f'ダウンロードエラー: {error or "出力がありません"}'}), 502
+
+    response = _pipe_download_response(_pipe_download_body(first_chunk, processes), mimetype, title, format_type)
+    # ボディが一度も読まれない場合もあるので、ジェネレーターではなくレスポンスのcloseで後始末する
+    response.call_on_close(lambda: _stop_pipe_processes(processes, info_file))
+    return response
 
 @app.route('/api/stream/<video_id>')
 @login_required
 def api_stream(video_id):
     try:
         stream_url = f"https://siawaseok.duckdns.org/api/stream/{video_id}/type2"
-        res = http_session.get(stream_url, headers=get_random_headers(), timeout=15)
+        res = http_session.get(stream_url, headers=get_random_headers(), timeout=upstream_timeout(15))
         if res.status_code == 200:
             data = res.json()
             return jsonify(data)
@@ -1193,7 +2697,7 @@ def api_lite_download(video_id):
 
     try:
         stream_url = f"https://siawaseok.duckdns.org/api/stream/{video_id}/type2"
-        res = http_session.get(stream_url, headers=get_random_headers(), timeout=15)
+        res = http_session.get(stream_url, headers=get_random_headers(), timeout=upstream_timeout(15))
 
         if res.status_code != 200:
             return jsonify({'error': 'ストリームデータの取得に失敗しました', 'success': False}), 500
@@ -1246,56 +2750,36 @@ def api_lite_download(video_id):
         print(f"Lite download error: {e}")
         return jsonify({'error': str(e), 'success': False}), 500
 
+def _best_audio_url(info):
+    """抽出結果から音声URLを選ぶ (m4aの音声のみ → その他の音声のみ → 音声付きの順、googlevideoを優先)"""
+    formats = [fmt for fmt in info.get('formats') or [] if fmt.get('url') and fmt.get('acodec') != 'none']
+    audio_only = [fmt for fmt in formats if fmt.get('vcodec') == 'none']
+    for candidates in ([fmt for fmt in audio_only if fmt.get('ext') == 'm4a'], audio_only, formats):
+        if not candidates:
+            continue
+        candidates = sorted(candidates, key=lambda fmt: ('googlevideo.com' in fmt['url'], fmt.get('abr') or fmt.get('tbr') or 0), reverse=True)
+        return candidates[0]['url']
+    return info.get('url')
+
 @app.route('/api/audio-stream/<video_id>')
 @login_required
 def api_audio_stream(video_id):
     try:
-        ydl_opts = {
-            'format': 'bestaudio[ext=m4a]/bestaudio/best',
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-        }
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=False)
-
-            audio_url = info.get('url')
-
-            if not audio_url:
-                formats = info.get('formats', [])
-                for fmt in formats:
-                    if fmt.get('acodec') != 'none' and fmt.get('vcodec') == 'none':
-                        audio_url = fmt.get('url')
-                        if audio_url and 'googlevideo.com' in audio_url:
-                            break
-
-                if not audio_url:
-                    for fmt in formats:
-                        if fmt.get('acodec') != 'none':
-                            url = fmt.get('url', '')
-                            if 'googlevideo.com' in url:
-                                audio_url = url
-                                break
-
-            if audio_url and 'googlevideo.com' in audio_url:
-                return jsonify({
-                    'success': True,
-                    'url': audio_url,
-                    'title': info.get('title', ''),
-                    'format': 'audio',
-                    'source': 'googlevideo'
-                })
-            elif audio_url:
-                return jsonify({
-                    'success': True,
-                    'url': audio_url,
-                    'title': info.get('title', ''),
-                    'format': 'audio',
-                    'source': 'other'
-                })
-            else:
-                return jsonify({'success': False, 'error': '音声URLが見つかりませんでした'}), 404
+        info = extract_video_info(video_id)
+        if not info:
+            return jsonify({'success': False, 'error': '音声URLが見つかりませんでした'}), 404
+
+        audio_url = _best_audio_url(info)
+        if audio_url:
+            return jsonify({
+                'success': True,
+                'url': audio_url,
+                'title': info.get('title', ''),
+                'format': 'audio',
+                'source': 'googlevideo' if 'googlevideo.com' in audio_url else 'other'
+            })
+        else:
+            return jsonify({'success': False, 'error': '音声URLが見つかりませんでした'}), 404
 
     except Exception as e:
         print(f"Audio stream error: {e}")
@@ -1318,18 +2802,23 @@ def api_thumbnail_download(video_id):
     thumbnail_url = f"https://i.ytimg.com/vi/{video_id}/{thumbnail_name}.jpg"
 
     try:
-        res = http_session.get(thumbnail_url, headers=get_random_headers(), timeout=10)
+        res = open_image_stream(thumbnail_url, timeout=10)
+
+        # maxresdefault等が存在しない場合は小さなプレースホルダー画像が返るので、サイズで判定する
+        if res is not None and int(res.headers.get('Content-Length') or 1001) <= 1000:
+            res.close()
+            res = None
 
-        if res.status_code == 200 and len(res.content) > 1000:
-            response = Response(res.content, mimetype='image/jpeg')
+        if res is not None:
+            response = streamed_image_response(res)
             response.headers['Content-Disposition'] = f'attachment; filename="{video_id}_{thumbnail_name}.jpg"'
             return response
 
         if quality != 'hq':
             fallback_url = f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg"
-            res = http_session.get(fallback_url, headers=get_random_headers(), timeout=10)
-            if res.status_code == 200:
-                response = Response(res.content, mimetype='image/jpeg')
+            res = open_image_stream(fallback_url, timeout=10)
+            if res is not None:
+                response = streamed_image_response(res)
                 response.headers['Content-Disposition'] = f'attachment; filename="{video_id}_hqdefault.jpg"'
                 return response
 
@@ -1341,6 +2830,7 @@ def api_thumbnail_download(video_id):
 
 @app.route('/playlist')
 @login_required
+@page_cache()
 def playlist_page():
     playlist_id = request.args.get('list', '')
     theme = request.cookies.get('theme', 'dark')
@@ -1352,6 +2842,7 @@ def playlist_page():
     playlist_info = get_playlist_info(playlist_id)
 
     if not playlist_info:
+        mark_page_degraded()
         return render_template('playlist.html', playlist=None, videos=[], theme=theme, vc=vc)
 
     return render_template('playlist.html',
@@ -1360,34 +2851,350 @@ def playlist_page():
                          theme=theme,
                          vc=vc)
 
+def thumbnail_cache_get(key):
+    global _thumbnail_cache_bytes
+    with _thumbnail_cache_lock:
+        entry = _thumbnail_cache.get(key)
+        if entry is None:
+            _thumbnail_cache_stats['misses'] += 1
+            return None
+        data, etag, cached_time = entry
+        if time.time() - cached_time >= THUMBNAIL_CACHE_TTL:
+            del _thumbnail_cache[key]
+            _thumbnail_cache_bytes -= len(data)
+            _thumbnail_cache_stats['misses'] += 1
+            return None
+        _thumbnail_cache.move_to_end(key)
+        _thumbnail_cache_stats['hits'] += 1
+        return data, etag
+
+def thumbnail_cache_set(key, data, etag):
+    global _thumbnail_cache_bytes
+    if len(data) > THUMBNAIL_CACHE_MAX_BYTES:
+        return
+    with _thumbnail_cache_lock:
+        old = _thumbnail_cache.pop(key, None)
+        if old is not None:
+            _thumbnail_cache_bytes -= len(old[0])
+        _thumbnail_cache[key] = (data, etag, time.time())
+        _thumbnail_cache_bytes += len(data)
+        while _thumbnail_cache_bytes > THUMBNAIL_CACHE_MAX_BYTES:
+            _, (evicted, _, _) = _thumbnail_cache.popitem(last=False)
+            _thumbnail_cache_bytes -= len(evicted)
+            _thumbnail_cache_stats['evictions'] += 1
+
+THUMBNAIL_ETAG_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+def _thumbnail_object_path(etag):
+    return os.path.join(THUMBNAIL_STORE_DIR, 'objects', etag[:2], etag)
+
+def _thumbnail_ref_path(key):
+    return os.path.join(THUMBNAIL_STORE_DIR, 'refs', hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+def _write_file_atomic(path, data):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    # 一時ファイル名は推測できないものを排他的に作成する (既存のファイルやシンボリックリンクは開かない)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def thumbnail_store_lookup(key):
+    """キーに対応するオブジェクトがディスクにあれば (etag, パス) を返す"""
+    if not THUMBNAIL_STORE_DIR:
+        return None
+    ref_path = _thumbnail_ref_path(key)
+    try:
+        if time.time() - os.path.getmtime(ref_path) >= THUMBNAIL_CACHE_TTL:
+            return None
+        with open(ref_path) as f:
+            etag = f.read().strip()
+        if not THUMBNAIL_ETAG_PATTERN.match(etag):
+            return None
+        path = _thumbnail_object_path(etag)
+        os.utime(path)
+        return etag, path
+    except OSError:
+        return None
+
+def thumbnail_store_put(key, data):
+    etag = hashlib.sha256(data).hexdigest()
+    if not THUMBNAIL_STORE_DIR:
+        return etag
+    try:
+        path = _thumbnail_object_path(etag)
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            _write_file_atomic(path, data)
+        _write_file_atomic(_thumbnail_ref_path(key), etag.encode('ascii'))
+    except OSError as e:
+        print(f"Thumbnail store write error: {e}")
+    _ensure_thumbnail_janitor()
+    return etag
+
+def _thumbnail_janitor():
+    while True:
+        time.sleep(THUMBNAIL_JANITOR_INTERVAL)
+        if not _shared_cache_acquire_lease('thumbnail_janitor', THUMBNAIL_JANITOR_INTERVAL):
+            continue
+        try:
+            objects = []
+            total = 0
+            for root, _, files in os.walk(os.path.join(THUMBNAIL_STORE_DIR, 'objects')):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    objects.append((st.st_mtime, st.st_size, path))
+                    total += st.st_size
+            # 最近使われていないものから上限を下回るまで削除する (参照が切れたrefは次回取得時に作り直される)
+            objects.sort()
+            for _, size, path in objects:
+                if total <= THUMBNAIL_STORE_MAX_BYTES:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+            ref_dir = os.path.join(THUMBNAIL_STORE_DIR, 'refs')
+            if os.path.isdir(ref_dir):
+                expire_before = time.time() - THUMBNAIL_CACHE_TTL
+                for name in os.listdir(ref_dir):
+                    path = os.path.join(ref_dir, name)
+                    try:
+                        if os.path.getmtime(path) < expire_before:
+                            os.remove(path)
+                    except OSError:
+                        pass
+        except Exception as e:
+            print(f"Thumbnail janitor error: {e}")
+
+def _ensure_thumbnail_janitor():
+    global _thumbnail_janitor_started
+    if _thumbnail_janitor_started:
+        return
+    with _thumbnail_cache_lock:
+        if _thumbnail_janitor_started:
+            return
+        _thumbnail_janitor_started = True
+    threading.Thread(target=_thumbnail_janitor, name='thumbnail-janitor', daemon=True).start()
+
+def open_image_stream(url, timeout=3):
+    """画像をストリーミングで取得する。有効な画像レスポンスでなければNone"""
+    res = http_session.get(url, headers=get_random_headers(), timeout=upstream_timeout(timeout), stream=True)
+    if res.status_code != 200 or not res.headers.get('Content-Type', '').startswith('image/'):
+        res.close()
+        return None
+    return res
+
+def stream_upstream_body(res, on_complete=None):
+    """上流のボディを届いた順にクライアントへ流し、on_completeがあれば全体を受け取った時点で渡す"""
+    chunks = [] if on_complete else None
+    completed = False
+    try:
+        for chunk in res.iter_content(chunk_size=THUMBNAIL_STREAM_CHUNK_SIZE):
+            if chunks is not None:
+                chunks.append(chunk)
+            yield chunk
+        completed = True
+    finally:
+        res.close()
+        if completed and chunks:
+            on_complete(b''.join(chunks))
+
+def streamed_image_response(res, mimetype='image/jpeg', on_complete=None, on_finish=None):
+    response = Response(stream_upstream_body(res, on_complete), mimetype=mimetype)
+    # HEADなどボディが一度も読まれない場合も後始末されるよう、ジェネレータではなくレスポンスのcloseで行う
+    response.call_on_close(res.close)
+    if on_finish:
+        response.call_on_close(on_finish)
+    if res.headers.get('Content-Length') and not res.headers.get('Content-Encoding'):
+        response.headers['Content-Length'] = res.headers['Content-Length']
+    return response
+
+def _claim_thumbnail_fetch(video_id):
+    """このホストで最初の取得者ならTrueを返す。他が取得中なら書き込みを少し待ってFalseを返す"""
+    with _thumbnail_fetches_lock:
+        event = _thumbnail_fetches.get(video_id)
+        if event is None:
+            _thumbnail_fetches[video_id] = threading.Event()
+    if event is not None:
+        event.wait(3)
+        return False
+
+    if _shared_cache_acquire_lease(f"thumbnail:{video_id}", 10):
+        return True
+
+    # 他のワーカーが取得中なので、ディスクに書き込まれるのを少し待つ
+    _release_thumbnail_fetch(video_id, release_lease=False)
+    wait_until = time.time() + 3
+    while time.time() < wait_until:
+        time.sleep(0.1)
+        if thumbnail_store_lookup(video_id):
+            break
+    return False
+
+def _release_thumbnail_fetch(video_id, release_lease=True):
+    if release_lease:
+        _shared_cache_release_lease(f"thumbnail:{video_id}")
+    with _thumbnail_fetches_lock:
+        event = _thumbnail_fetches.pop(video_id, None)
+    if event is not None:
+        event.set()
+
+def _store_thumbnail(video_id, content):
+    etag = thumbnail_store_put(video_id, content)
+    thumbnail_cache_set(video_id, content, etag)
+
+def _thumbnail_response(data, etag, mimetype='image/jpeg'):
+    response = Response(data, mimetype=mimetype)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response.make_conditional(request)
+
+def _send_stored_thumbnail(etag, path, mimetype='image/jpeg'):
+    # ディスク上のファイルはsend_file経由でsendfileにより送信する
+    response = send_file(path, mimetype=mimetype, etag=etag, max_age=3600, conditional=True)
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response
+
+def _supports_image_format(fmt):
+    return Image is not None and THUMBNAIL_FORMATS[fmt]['pil'] in Image.SAVE
+
+def _negotiate_thumbnail_format(requested):
+    if requested in THUMBNAIL_FORMATS and _supports_image_format(requested):
+        return requested
+    accept = request.headers.get('Accept', '')
+    for fmt in ('avif', 'webp'):
+        if THUMBNAIL_FORMATS[fmt]['mimetype'] in accept and _supports_image_format(fmt):
+            return fmt
+    return 'jpeg'
+
+def _thumbnail_width(value):
+    try:
+        width = int(value)
+    except (TypeError, ValueError):
+        return None
+    # 任意の幅を許すとバリアントが無限に増えるので、用意した幅に丸める
+    return next((w for w in THUMBNAIL_WIDTHS if w >= width), None)
+
+def _transcode_thumbnail(data, width, fmt):
+    image = Image.open(io.BytesIO(data))
+    image = image.convert('RGB')
+    if width and width < image.width:
+        height = max(1, round(image.height * width / image.width))
+        image = image.resize((width, height), Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, THUMBNAIL_FORMATS[fmt]['pil'], **THUMBNAIL_FORMATS[fmt]['options'])
+    return output.getvalue()
+
+def _get_original_thumbnail(video_id):
+    cached = thumbnail_cache_get(video_id)
+    if cached is not None:
+        return cached[0]
+    stored = thumbnail_store_lookup(video_id)
+    if stored is not None:
+        with open(stored[1], 'rb') as f:
+            return f.read()
+    res = open_image_stream(f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg")
+    if res is None:
+        return None
+    try:
+        content = res.content
+    finally:
+        res.close()
+    _store_thumbnail(video_id, content)
+    return content
+
+def _build_thumbnail_variant(video_id, key, width, fmt):
+    original = _get_original_thumbnail(video_id)
+    if not original:
+        return None
+    data = _image_executor.submit(_transcode_thumbnail, original, width, fmt).result()
+    etag = thumbnail_store_put(key, data)
+    thumbnail_cache_set(key, data, etag)
+    return data, etag
+
+def _thumbnail_variant(video_id, width, fmt):
+    key = f"{video_id}:{width or 0}:{fmt}"
+    mimetype = THUMBNAIL_FORMATS[fmt]['mimetype']
+
+    cached = thumbnail_cache_get(key)
+    if cached is not None:
+        return _thumbnail_response(cached[0], cached[1], mimetype)
+
+    stored = thumbnail_store_lookup(key)
+    if stored is not None:
+        return _send_stored_thumbnail(stored[0], stored[1], mimetype)
+
+    try:
+        variant = single_flight(('thumbnail_variant', key), _build_thumbnail_variant, video_id, key, width, fmt)
+    except Exception as e:
+        print(f"Thumbnail variant error ({key}): {e}")
+        variant = None
+    if variant is None:
+        return '', 404
+    return _thumbnail_response(variant[0], variant[1], mimetype)
+
 @app.route('/thumbnail')
 def thumbnail():
     video_id = request.args.get('v', '')
     if not video_id:
         return '', 404
 
-    current_time = time.time()
-    cache_key = video_id
-    if cache_key in _thumbnail_cache:
-        cached_data, cached_time = _thumbnail_cache[cache_key]
-        if current_time - cached_time < 3600:
-            response = Response(cached_data, mimetype='image/jpeg')
-            response.headers['Cache-Control'] = 'public, max-age=3600'
-            return response
+    width = _thumbnail_width(request.args.get('w'))
+    fmt = _negotiate_thumbnail_format(request.args.get('fmt', 'auto'))
+    if Image is not None and (width or fmt != 'jpeg'):
+        response = _thumbnail_variant(video_id, width, fmt)
+        if isinstance(response, Response) and request.args.get('fmt', 'auto') not in THUMBNAIL_FORMATS:
+            response.headers['Vary'] = 'Accept'
+        return response
+
+    cached = thumbnail_cache_get(video_id)
+    if cached is not None:
+        data, etag = cached
+        return _thumbnail_response(data, etag)
 
+    stored = thumbnail_store_lookup(video_id)
+    claimed = False
+    if stored is None:
+        claimed = _claim_thumbnail_fetch(video_id)
+        if not claimed:
+            stored = thumbnail_store_lookup(video_id)
+
+    if stored is not None:
+        etag, path = stored
+        return _send_stored_thumbnail(etag, path)
+
+    # 上流から届いたバイトをそのままクライアントへ流しつつ、キャッシュにも書き込む
+    on_finish = (lambda: _release_thumbnail_fetch(video_id)) if claimed else None
     try:
-        url = f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg"
-        res = http_session.get(url, headers=get_random_headers(), timeout=3)
-        if len(_thumbnail_cache) > 500:
-            oldest_key = min(_thumbnail_cache.keys(), key=lambda k: _thumbnail_cache[k][1])
-            del _thumbnail_cache[oldest_key]
-        _thumbnail_cache[cache_key] = (res.content, current_time)
-        response = Response(res.content, mimetype='image/jpeg')
-        response.headers['Cache-Control'] = 'public, max-age=3600'
-        return response
+        res = open_image_stream(f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg")
     except:
+        res = None
+    if res is None:
+        if on_finish:
+            on_finish()
         return '', 404
 
+    response = streamed_image_response(res, on_complete=lambda content: _store_thumbnail(video_id, content), on_finish=on_finish)
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    if request.args.get('fmt', 'auto') not in THUMBNAIL_FORMATS:
+        response.headers['Vary'] = 'Accept'
+    return response
+
 @app.route('/suggest')
 def suggest():
     keyword = request.args.get('keyword', '')
@@ -1397,25 +3204,13 @@ def suggest():
 @app.route('/comments')
 def comments_api():
     video_id = request.args.get('v', '')
-    comments = get_comments(video_id)
-
-    html = ''
-    for comment in comments:
-        html += f'''
-        <div class="comment">
-            <img src="{comment['authorThumbnail']}" alt="{comment['author']}" class="comment-avatar">
-            <div class="comment-content">
-                <div class="comment-header">
-                    <a href="/channel/{comment['authorId']}" class="comment-author">{comment['author']}</a>
-                    <span class="comment-date">{comment['published']}</span>
-                </div>
-                <div class="comment-text">{comment['content']}</div>
-                <div class="comment-likes">👍 {comment['likes']}</div>
-            </div>
-        </div>
-        '''
-
-    return html if html else '<p class="no-comments">コメントはありません</p>'
+    continuation = request.args.get('continuation', '')
+    page = get_comments_page(video_id, continuation) or {'comments': [], 'continuation': ''}
+    return render_template('comments_fragment.html',
+                         video_id=video_id,
+                         comments=page['comments'],
+                         continuation=page['continuation'],
+                         first_page=not continuation)
 
 @app.route('/api/search')
 def api_search():
@@ -1432,6 +3227,15 @@ def api_video(video_id):
     streams = get_stream_url(video_id)
     return jsonify({'info': info, 'streams': streams})
 
+@app.route('/api/cache-stats')
+@login_required
+def api_cache_stats():
+    with _thumbnail_cache_lock:
+        thumbnail_stats = dict(_thumbnail_cache_stats, entries=len(_thumbnail_cache), bytes=_thumbnail_cache_bytes)
+    with _metadata_cache_lock:
+        metadata_stats = dict(_metadata_cache_stats, entries=len(_metadata_cache), bytes=_metadata_cache_bytes)
+    return jsonify({'thumbnail': thumbnail_stats, 'metadata': metadata_stats})
+
 @app.route('/api/trending')
 def api_trending():
     videos = get_trending()
@@ -1471,7 +3275,7 @@ def api_getcode():
             'Connection': 'keep-alive',
         }
 
-        res = http_session.get(url, headers=headers, timeout=15, allow_redirects=True)
+        res = http_session.get(url, headers=headers, timeout=upstream_timeout(15), allow_redirects=True)
         res.raise_for_status()
 
         content_type = res.headers.get('Content-Type', '')
@@ -1516,22 +3320,14 @@ def api_convert_converthub(video_id):
         return jsonify({'success': False, 'error': 'ConvertHub APIキーが設定されていません'}), 400
     
     try:
-        video_url = f"https://www.youtube.com/watch?v={video_id}"
         unique_id = f"{video_id}_{int(time.time())}"
         
-        cookie_file = os.path.join(DOWNLOAD_DIR, f'cookies_convert_{unique_id}.txt')
-        create_youtube_cookies(cookie_file)
-        
         output_template = os.path.join(DOWNLOAD_DIR, f'chocotube_convert_{unique_id}.%(ext)s')
-        ydl_opts = get_yt_dlp_base_opts(output_template, cookie_file)
+        ydl_opts = get_yt_dlp_base_opts(output_template)
         ydl_opts['format'] = 'bestaudio[ext=m4a]/bestaudio/best'
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=True)
-            title = sanitize_filename(info.get('title', video_id) if info else video_id)
-        
-        if os.path.exists(cookie_file):
-            os.remove(cookie_file)
+        info = ydl_download(video_id, ydl_opts)
+        title = sanitize_filename(info.get('title', video_id) if info else video_id)
         
         source_file = None
         for ext in ['m4a', 'webm', 'mp3', 'opus']:
@@ -1609,22 +3405,14 @@ def api_convert_transloadit(video_id):
         return jsonify({'success': False, 'error': 'Transloadit APIキーが設定されていません'}), 400
     
     try:
-        video_url = f"https://www.youtube.com/watch?v={video_id}"
         unique_id = f"{video_id}_{int(time.time())}"
         
-        cookie_file = os.path.join(DOWNLOAD_DIR, f'cookies_transloadit_{unique_id}.txt')
-        create_youtube_cookies(cookie_file)
-        
         output_template = os.path.join(DOWNLOAD_DIR, f'chocotube_transloadit_{unique_id}.%(ext)s')
-        ydl_opts = get_yt_dlp_base_opts(output_template, cookie_file)
+        ydl_opts = get_yt_dlp_base_opts(output_template)
         ydl_opts['format'] = 'bestaudio[ext=m4a]/bestaudio/best'
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=True)
-            title = sanitize_filename(info.get('title', video_id) if info else video_id)
-        
-        if os.path.exists(cookie_file):
-            os.remove(cookie_file)
+        info = ydl_download(video_id, ydl_opts)
+        title = sanitize_filename(info.get('title', video_id) if info else video_id)
         
         source_file = None
         for ext in ['m4a', 'webm', 'mp3', 'opus']:
@@ -1735,22 +3523,14 @@ def api_convert_freeconvert(video_id):
         return jsonify({'success': False, 'error': 'FreeConvert APIキーが設定されていません'}), 400
     
     try:
-        video_url = f"https://www.youtube.com/watch?v={video_id}"
         unique_id = f"{video_id}_{int(time.time())}"
         
-        cookie_file = os.path.join(DOWNLOAD_DIR, f'cookies_freeconvert_{unique_id}.txt')
-        create_youtube_cookies(cookie_file)
-        
         output_template = os.path.join(DOWNLOAD_DIR, f'chocotube_freeconvert_{unique_id}.%(ext)s')
-        ydl_opts = get_yt_dlp_base_opts(output_template, cookie_file)
+        ydl_opts = get_yt_dlp_base_opts(output_template)
         ydl_opts['format'] = 'bestaudio[ext=m4a]/bestaudio/best'
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=True)
-            title = sanitize_filename(info.get('title', video_id) if info else video_id)
-        
-        if os.path.exists(cookie_file):
-            os.remove(cookie_file)
+        info = ydl_download(video_id, ydl_opts)
+        title = sanitize_filename(info.get('title', video_id) if info else video_id)
         
         source_file = None
         source_format = 'm4a'
@@ -1858,22 +3638,14 @@ def api_convert_apify(video_id):
         return jsonify({'success': False, 'error': 'Apify APIトークンが設定されていません'}), 400
     
     try:
-        video_url = f"https://www.youtube.com/watch?v={video_id}"
         unique_id = f"{video_id}_{int(time.time())}"
         
-        cookie_file = os.path.join(DOWNLOAD_DIR, f'cookies_apify_{unique_id}.txt')
-        create_youtube_cookies(cookie_file)
-        
         output_template = os.path.join(DOWNLOAD_DIR, f'chocotube_apify_{unique_id}.%(ext)s')
-        ydl_opts = get_yt_dlp_base_opts(output_template, cookie_file)
+        ydl_opts = get_yt_dlp_base_opts(output_template)
         ydl_opts['format'] = 'bestaudio[ext=m4a]/bestaudio/best'
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=True)
-            title = sanitize_filename(info.get('title', video_id) if info else video_id)
-        
-        if os.path.exists(cookie_file):
-            os.remove(cookie_file)
+        info = ydl_download(video_id, ydl_opts)
+        title = sanitize_filename(info.get('title', video_id) if info else video_id)
         
         source_file = None
         for ext in ['m4a', 'webm', 'mp3', 'opus']:
@@ -1940,14 +3712,17 @@ def api_convert_direct(video_id):
     
     try:
         video_info = None
-        for instance in INVIDIOUS_INSTANCES[:3]:
+        for instance in pick_invidious_instances(3):
+            start = time.time()
             try:
                 url = f"{instance}api/v1/videos/{video_id}"
-                res = http_session.get(url, headers=get_random_headers(), timeout=10)
+                res = http_session.get(url, headers=get_random_headers(), timeout=upstream_timeout(10))
+                record_instance_result(instance, res.status_code in (200, 404), time.time() - start)
                 if res.status_code == 200:
                     video_info = res.json()
                     break
             except:
+                record_instance_result(instance, False)
                 continue
         
         title = sanitize_filename(video_info.get('title', video_id)) if video_info else video_id
@@ -1955,7 +3730,7 @@ def api_convert_direct(video_id):
         
         try:
             api_url = f'https://api.vevioz.com/api/button/mp3/{video_id}'
-            res = http_session.get(api_url, headers=get_random_headers(), timeout=30)
+            res = http_session.get(api_url, headers=get_random_headers(), timeout=upstream_timeout(30))
             if res.status_code == 200:
                 import re
                 match = re.search(r'href="(https://[^"]+\.mp3[^"]*)"', res.text)
@@ -1974,7 +3749,7 @@ def api_convert_direct(video_id):
         try:
             api_url = f'https://api.mp3download.to/v1/convert'
             payload = {'url': youtube_url, 'format': 'mp3'}
-            res = http_session.post(api_url, json=payload, headers={'Content-Type': 'application/json'}, timeout=30)
+            res = http_session.post(api_url, json=payload, headers={'Content-Type': 'application/json'}, timeout=upstream_timeout(30))
             if res.status_code == 200:
                 data = res.json()
                 if data.get('download_url'):
@@ -1994,7 +3769,7 @@ def api_convert_direct(video_id):
             res = http_session.post(api_url, data=payload, headers={
                 'Content-Type': 'application/x-www-form-urlencoded',
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            }, timeout=30)
+            }, timeout=upstream_timeout(30))
             if res.status_code == 200:
                 data = res.json()
                 if data.get('links') and data['links'].get('mp3'):
@@ -2002,7 +3777,7 @@ def api_convert_direct(video_id):
                         if info.get('k'):
                             convert_url = 'https://yt1s.io/api/ajaxConvert/convert'
                             convert_payload = {'vid': video_id, 'k': info['k']}
-                            conv_res = http_session.post(convert_url, data=convert_payload, timeout=60)
+                            conv_res = http_session.post(convert_url, data=convert_payload, timeout=upstream_timeout(60))
                             if conv_res.status_code == 200:
                                 conv_data = conv_res.json()
                                 if conv_data.get('dlink'):
@@ -2020,7 +3795,7 @@ def api_convert_direct(video_id):
         try:
             api_url = f'https://tomp3.cc/api/ajax/search'
             payload = {'query': youtube_url, 'vt': 'mp3'}
-            res = http_session.post(api_url, data=payload, timeout=30)
+            res = http_session.post(api_url, data=payload, timeout=upstream_timeout(30))
             if res.status_code == 200:
                 data = res.json()
                 if data.get('url'):
@@ -2034,7 +3809,7 @@ def api_convert_direct(video_id):
         except Exception as e:
             print(f"ToMP3 API error: {e}")
         
-        for instance in INVIDIOUS_INSTANCES[:5]:
+        for instance in pick_invidious_instances(5):
             try:
                 audio_url = f"{instance}latest_version?id={video_id}&itag=140"
                 return jsonify({
@@ -2053,11 +3828,196 @@ def api_convert_direct(video_id):
         print(f"Direct convert error: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# ルートごとのキャッシュポリシー (ここにないHTMLページは private, no-cache)
+NO_STORE_POLICY = 'no-cache, no-store, must-revalidate'
+DEFAULT_CACHE_POLICY = 'private, no-cache'
+CACHE_POLICIES = {
+    'static': 'public, max-age=31536000, immutable',
+    'thumbnail': 'public, max-age=3600',
+    'api_thumbnail_download': 'private, max-age=3600',
+    'suggest': 'private, max-age=300',
+    'api_search': 'private, max-age=60',
+    'api_video': 'private, max-age=60',
+    'api_video_info': 'private, max-age=60',
+    'api_trending': 'private, max-age=60',
+    'api_channel_videos': 'private, max-age=60',
+    'comments_api': 'private, max-age=60',
+    'login': NO_STORE_POLICY,
+    'api_getcode': NO_STORE_POLICY,
+    'api_cache_stats': NO_STORE_POLICY,
+    'api_download': NO_STORE_POLICY,
+    'api_internal_download': NO_STORE_POLICY,
+    'api_submit_download_job': NO_STORE_POLICY,
+    'api_download_job_status': NO_STORE_POLICY,
+    'api_download_job_events': NO_STORE_POLICY,
+    'api_download_job_file': NO_STORE_POLICY,
+    'api_pipe_download': NO_STORE_POLICY,
+    'api_stream': NO_STORE_POLICY,
+    'api_lite_download': NO_STORE_POLICY,
+    'api_audio_stream': NO_STORE_POLICY,
+    'api_convert_converthub': NO_STORE_POLICY,
+    'api_convert_transloadit': NO_STORE_POLICY,
+    'api_convert_freeconvert': NO_STORE_POLICY,
+    'api_convert_apify': NO_STORE_POLICY,
+    'api_convert_direct': NO_STORE_POLICY,
+}
+
+@lru_cache(maxsize=None)
+def static_file_hash(filename):
+    try:
+        with open(os.path.join(app.static_folder, filename), 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()[:12]
+    except OSError:
+        return None
+
+@app.url_defaults
+def add_static_fingerprint(endpoint, values):
+    """テンプレートのurl_for('static', ...)に内容のハッシュを付け、長期キャッシュできるURLにする"""
+    if endpoint == 'static' and 'v' not in values:
+        file_hash = static_file_hash(values.get('filename', ''))
+        if file_hash:
+            values['v'] = file_hash
+
+def cache_policy_for(response):
+    # リダイレクト (ログイン誘導など) やエラーはセッション依存なので保存させない
+    if response.status_code >= 300 and response.status_code != 304:
+        return NO_STORE_POLICY
+    if request.endpoint == 'static' and not request.args.get('v'):
+        return 'public, max-age=3600'
+    return CACHE_POLICIES.get(request.endpoint, DEFAULT_CACHE_POLICY)
+
 @app.after_request
 def add_header(response):
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
+    policy = cache_policy_for(response)
+    response.headers['Cache-Control'] = policy
+    if policy == NO_STORE_POLICY:
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '0'
+    return response
+
+# レスポンス圧縮 (gzip / brotli)
+COMPRESS_MIMETYPES = {
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/javascript',
+    'application/javascript',
+    'application/json',
+    'image/svg+xml',
+}
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_STATIC_MAX_SIZE = 1024 * 1024
+COMPRESS_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+_compressed_cache = OrderedDict()
+_compressed_cache_bytes = 0
+_compressed_cache_lock = threading.Lock()
+
+def _choose_encoding():
+    accept_encoding = request.headers.get('Accept-Encoding', '')
+    if brotli is not None and 'br' in accept_encoding:
+        return 'br'
+    if 'gzip' in accept_encoding:
+        return 'gzip'
+    return None
+
+def _compress_bytes(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+def _compress_cached(data, encoding):
+    """同じ内容の圧縮結果を再利用する (キャッシュ可能なレスポンスのみ)"""
+    return _compress_with_cache((encoding, hashlib.sha1(data).digest()), lambda: data, encoding)
+
+def _compress_static_file(encoding):
+    """静的ファイルはパスと更新時刻ごとに1度だけ圧縮して使い回す。対象外ならNone"""
+    path = safe_join(app.static_folder, (request.view_args or {}).get('filename', ''))
+    try:
+        st = os.stat(path)
+    except (TypeError, OSError):
+        return None
+    if not COMPRESS_MIN_SIZE <= st.st_size <= COMPRESS_STATIC_MAX_SIZE:
+        return None
+
+    def load():
+        with open(path, 'rb') as f:
+            return f.read()
+    return _compress_with_cache((encoding, path, st.st_mtime_ns, st.st_size), load, encoding)
+
+def _compress_with_cache(key, load, encoding):
+    global _compressed_cache_bytes
+    with _compressed_cache_lock:
+        compressed = _compressed_cache.get(key)
+        if compressed is not None:
+            _compressed_cache.move_to_end(key)
+            return compressed
+    compressed = _compress_bytes(load(), encoding)
+    with _compressed_cache_lock:
+        if key not in _compressed_cache:
+            _compressed_cache[key] = compressed
+            _compressed_cache_bytes += len(compressed)
+            while _compressed_cache_bytes > COMPRESS_CACHE_MAX_BYTES:
+                _, evicted = _compressed_cache.popitem(last=False)
+                _compressed_cache_bytes -= len(evicted)
+    return compressed
+
+def _compress_stream(chunks, encoding):
+    # チャンクごとにフラッシュして、ストリーミングの逐次表示を損なわないようにする
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=4)
+        for chunk in chunks:
+            if chunk:
+                yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            if chunk:
+                yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+def _is_cacheable(response):
+    # after_requestは登録と逆順に実行され、この時点ではまだadd_headerが動いていないので方針を直接求める
+    cache_control = cache_policy_for(response)
+    return 'no-store' not in cache_control and 'no-cache' not in cache_control
+
+@app.after_request
+def compress_response(response):
+    if response.status_code != 200 or 'Content-Encoding' in response.headers or request.method == 'HEAD':
+        return response
+    if response.mimetype not in COMPRESS_MIMETYPES:
+        return response
+    encoding = _choose_encoding()
+    if encoding is None:
+        return response
+
+    if response.direct_passthrough:
+        # send_fileのファイルを毎回メモリに読み込まないよう、圧縮するのは静的ファイルの使い回しだけにする
+        compressed = _compress_static_file(encoding) if request.endpoint == 'static' else None
+        if compressed is None:
+            return response
+        body = response.response
+        response.direct_passthrough = False
+        response.set_data(compressed)
+        if hasattr(body, 'close'):
+            body.close()
+    elif response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(_compress_cached(data, encoding) if _is_cacheable(response) else _compress_bytes(data, encoding))
+
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # 圧縮後は別のバイト列なので弱いETagにする
+        response.set_etag(etag, weak=True)
     return response
 
 if __name__ == '__main__':
@@ -0,0 +1,115 @@
+"""yt-dlp周りの起動時間と1回あたりのオーバーヘッドを計測する
+
+    python bench_yt_dlp.py                 # ネットワークを使わない計測のみ
+    python bench_yt_dlp.py --url VIDEO_ID  # 実際の抽出 (初回/2回目) も計測する
+
+before: 毎回cookieファイルを書き出して新しいYoutubeDLを作る従来の方法
+after:  プール済みのYoutubeDLを借りて返す方法 (cookieはメモリ上)
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+COOKIES_CONTENT = """# Netscape HTTP Cookie File
+.youtube.com    TRUE    /       TRUE    2147483647      CONSENT PENDING+987
+.youtube.com    TRUE    /       TRUE    2147483647      SOCS    CAESEwgDEgk2MjQyNTI1NzkaAmphIAEaBgiA_LyuBg
+.youtube.com    TRUE    /       TRUE    2147483647      PREF    tz=Asia.Tokyo&hl=ja&gl=JP
+.youtube.com    TRUE    /       TRUE    2147483647      GPS     1
+.youtube.com    TRUE    /       TRUE    2147483647      YSC     DwKYllHNwuw
+.youtube.com    TRUE    /       TRUE    2147483647      VISITOR_INFO1_LIVE      random_visitor_id
+"""
+
+
+def time_subprocess(code, runs):
+    """新しいPythonプロセスでcodeを実行し、所要時間(秒)の一覧を返す"""
+    env = dict(os.environ, SHARED_CACHE_PATH='', INSTANCE_PROBE_INTERVAL='0')
+    results = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        results.append(time.perf_counter() - start)
+    return results
+
+
+def time_calls(fn, runs):
+    results = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        results.append(time.perf_counter() - start)
+    return results
+
+
+def report(label, results):
+    print(f"{label:<44} median {statistics.median(results) * 1000:9.1f} ms"
+          f"   min {min(results) * 1000:9.1f} ms   (n={len(results)})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='起動時間の計測回数')
+    parser.add_argument('--calls', type=int, default=50, help='1回あたりのオーバーヘッドの計測回数')
+    parser.add_argument('--url', help='実際に抽出を計測する動画IDまたはURL')
+    args = parser.parse_args()
+
+    print('== cold start ==')
+    report('python -c pass', time_subprocess('pass', args.runs))
+    report('import yt_dlp', time_subprocess('import yt_dlp', args.runs))
+    report('import app (yt_dlp is lazy)', time_subprocess('import app', args.runs))
+    report('import app + first YoutubeDL', time_subprocess('import app; app.release_ydl(app.acquire_ydl())', args.runs))
+
+    os.environ.setdefault('SHARED_CACHE_PATH', '')
+    os.environ.setdefault('INSTANCE_PROBE_INTERVAL', '0')
+    sys.path.insert(0, ROOT)
+    import app
+    yt_dlp = app.get_yt_dlp()
+    output_template = os.path.join(tempfile.gettempdir(), '%(id)s.%(ext)s')
+
+    def before():
+        cookie_file = os.path.join(tempfile.gettempdir(), f'bench_cookies_{os.getpid()}.txt')
+        with open(cookie_file, 'w') as f:
+            f.write(COOKIES_CONTENT)
+        # 従来のcookieファイルは区切りがタブでないため読み込み時に警告が出る (計測には影響しないので捨てる)
+        with contextlib.redirect_stderr(io.StringIO()):
+            with yt_dlp.YoutubeDL(app.get_yt_dlp_base_opts(output_template, cookie_file)) as ydl:
+                ydl.get_info_extractor('Youtube')
+        os.remove(cookie_file)
+
+    def after():
+        app.release_ydl(app.acquire_ydl())
+
+    print()
+    print('== per-call overhead (no network) ==')
+    report('before: cookie file + new YoutubeDL', time_calls(before, args.calls))
+    app.release_ydl(app.acquire_ydl())
+    report('after: pooled YoutubeDL', time_calls(after, args.calls))
+
+    if args.url:
+        url = args.url if '://' in args.url else f'https://www.youtube.com/watch?v={args.url}'
+
+        def extract_fresh():
+            with yt_dlp.YoutubeDL(app.get_yt_dlp_base_opts(output_template)) as ydl:
+                ydl.extract_info(url, download=False)
+
+        def extract_pooled():
+            ydl = app.acquire_ydl()
+            ydl.extract_info(url, download=False)
+            app.release_ydl(ydl)
+
+        print()
+        print('== extract_info (network) ==')
+        report('before: new YoutubeDL each call', time_calls(extract_fresh, 3))
+        report('after: pooled YoutubeDL (1st is cold)', time_calls(extract_pooled, 3))
+
+
+if __name__ == '__main__':
+    main()